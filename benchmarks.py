@@ -0,0 +1,312 @@
+"""Micro-benchmarks for the debug toolbar overhead.
+
+Run all the benchmarks: ::
+
+    python benchmarks.py
+
+Or some of them: ::
+
+    python benchmarks.py logging
+
+"""
+import gzip
+import ipaddress as ip
+import logging
+import os.path as op
+import random
+import re
+import sys
+import timeit
+import zlib
+from types import SimpleNamespace
+
+from muffin_debugtoolbar import utils
+
+
+def report(name, seconds, number):
+    """Print a benchmark's result."""
+    print("  %-50s %10.3f us" % (name, seconds * 1e6 / number))
+
+
+def handler(awaits):
+    """Simulate a handler which is suspended the given times."""
+    for _ in range(awaits):
+        yield
+
+
+def drive(coro):
+    """Run the coroutine like an event loop does."""
+    for _ in coro:
+        pass
+
+
+def bench_logging(awaits=200, number=2000):
+    """Per-await overhead of the logging panel."""
+    print("Logging panel (a handler with %d awaits), per request:" % awaits)
+
+    report('without the toolbar', timeit.timeit(
+        lambda: drive(handler(awaits)), number=number), number)
+
+    # Before: add/remove a handler on the root logger on each context switch
+    tracking = logging.Handler()
+    switcher = utils.ContextSwitcher()
+    switcher.add_context_in(lambda: logging.root.addHandler(tracking))
+    switcher.add_context_out(lambda: logging.root.removeHandler(tracking))
+    report('root handler juggling (before)', timeit.timeit(
+        lambda: drive(switcher(handler(awaits))), number=number), number)
+
+    # After: the records are routed by the context variable, nothing is done on switches
+    switcher = utils.ContextSwitcher()
+
+    def run():
+        token = utils.LOG_RECORDS.set([])
+        drive(switcher(handler(awaits)))
+        utils.LOG_RECORDS.reset(token)
+
+    report('contextvars routed records (after)', timeit.timeit(run, number=number), number)
+
+    print("Logging panel, per log record:")
+    logger = logging.getLogger('benchmarks')
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    tracker = utils.LogRecordTracker()
+    tracker.install()
+    token = utils.LOG_RECORDS.set([])
+    report('capture a record', timeit.timeit(
+        lambda: logger.warning('message %s', 42), number=number), number)
+    utils.LOG_RECORDS.reset(token)
+    report('skip a record (not captured request)', timeit.timeit(
+        lambda: logger.warning('message %s', 42), number=number), number)
+    tracker.uninstall()
+
+
+def legacy_switcher(expr, context_in, context_out):
+    """The context switcher before the rebuild (PEP 380 reimplemented in a generator)."""
+    for callback in context_in:
+        callback()
+
+    _i = iter(expr)
+    try:
+        _y = next(_i)
+    except StopIteration as _e:
+        _r = _e.value
+    else:
+        while 1:
+            try:
+                for callback in context_out:
+                    callback()
+                _s = yield _y
+                for callback in context_in:
+                    callback()
+            except GeneratorExit as _e:
+                _i.close()
+                raise _e
+            except BaseException:
+                try:
+                    _y = _i.throw(*sys.exc_info())
+                except StopIteration as _e:
+                    _r = _e.value
+                    break
+            else:
+                try:
+                    _y = next(_i) if _s is None else _i.send(_s)
+                except StopIteration as _e:
+                    _r = _e.value
+                    break
+    for callback in context_out:
+        callback()
+    return _r
+
+
+def bench_context_switcher(awaits=200, number=2000):
+    """Overhead of the context switches tracking."""
+    from muffin_debugtoolbar import panels
+
+    print("Context switcher (a handler with %d awaits), per request:" % awaits)
+
+    report('without the toolbar', timeit.timeit(
+        lambda: drive(handler(awaits)), number=number), number)
+
+    report('legacy generator, no callbacks (before)', timeit.timeit(
+        lambda: drive(legacy_switcher(handler(awaits), [], [])), number=number), number)
+
+    switcher = utils.ContextSwitcher()
+    report('no callbacks (after)', timeit.timeit(
+        lambda: drive(switcher(handler(awaits))), number=number), number)
+
+    empty = [lambda: None]
+    report('legacy generator, empty in/out callbacks (before)', timeit.timeit(
+        lambda: drive(legacy_switcher(handler(awaits), empty, empty)), number=number), number)
+
+    switcher.add_context_in(lambda: None)
+    switcher.add_context_out(lambda: None)
+    report('empty in/out callbacks (after)', timeit.timeit(
+        lambda: drive(switcher(handler(awaits))), number=number), number)
+
+    # The default panels which track the switches (the watchdog's callbacks are the same)
+    timing = panels.TimingDebugPanel(None)
+    report('legacy generator, timing panel (before)', timeit.timeit(
+        lambda: drive(legacy_switcher(
+            handler(awaits), [timing.context_in], [timing.context_out])),
+        number=number), number)
+
+    switcher = utils.ContextSwitcher()
+    timing.wrap_handler(None, switcher)
+    report('timing panel (after)', timeit.timeit(
+        lambda: drive(switcher(handler(awaits))), number=number), number)
+
+    import resource
+    who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+    switcher = utils.ContextSwitcher()
+    switcher.add_context_in(lambda: resource.getrusage(who))
+    switcher.add_context_out(lambda: resource.getrusage(who))
+    report('getrusage in/out callbacks (the opt-in Resources panel)', timeit.timeit(
+        lambda: drive(switcher(handler(awaits))), number=number), number)
+
+
+def fake_request(path='/', method='GET', host='127.0.0.1', headers=None, cookies=None):
+    """Build a minimal request-like object."""
+    return SimpleNamespace(
+        path=path, method=method, headers=headers or {}, cookies=cookies or {}, GET={},
+        transport=SimpleNamespace(get_extra_info=lambda name: (host, 54321)))
+
+
+def bench_request_filter(number=100000):
+    """Per-request cost of deciding whether to capture a request."""
+    hosts = ['127.0.0.1', '10.0.0.0/8', '192.168.0.0/16']
+    exclude = ['/static/', '/_debug/']
+
+    def check_before(request):
+        # The inline checks of the middleware before the filter has been compiled
+        if any(map(request.path.startswith, exclude)):
+            return False
+        remote_host, remote_port = request.transport.get_extra_info('peername')
+        for host in hosts:
+            if ip.ip_address(remote_host) in ip.ip_network(host):
+                return True
+        return False
+
+    requests = [
+        ('matching request', fake_request(host='192.168.1.1')),
+        ('excluded path', fake_request(path='/static/app.js')),
+        ('not allowed host', fake_request(host='8.8.8.8')),
+    ]
+    print("Request filter, per request:")
+    for name, request in requests:
+        report('%s (before)' % name, timeit.timeit(
+            lambda: check_before(request), number=number), number)
+
+    request_filter = utils.RequestFilter(hosts=hosts, exclude=exclude)
+    for name, request in requests:
+        report('%s (compiled)' % name, timeit.timeit(
+            lambda: request_filter(request), number=number), number)
+
+    request_filter = utils.RequestFilter(hosts=hosts, exclude=exclude, flag='debug')
+    report('not flagged request (compiled, opt-in flag)', timeit.timeit(
+        lambda: request_filter(requests[0][1]), number=number), number)
+
+
+def html_page(size):
+    """Generate a HTML page of the given size."""
+    row = b'<tr><td>Lorem ipsum dolor sit amet</td><td>42</td></tr>\n'
+    return b'<html><body><table>' + row * (size // len(row)) + b'</table></body></html>'
+
+
+def bench_compressed_injection(size=1024 * 1024, number=20):
+    """Injection into a compressed body vs. disabling compression for debugged requests."""
+    print("Injection into a compressed %d KB HTML body, per response:" % (size // 1024))
+    body = html_page(size)
+    snippet = b'<div id="pDebug">...</div>' * 20
+    tag = re.compile(b'</body>', re.I)
+
+    def disabled():
+        # Compression is disabled: inject into the plain body and send it as is
+        return tag.sub(snippet + b'</body>', body)
+
+    def recompress():
+        # The whole body is compressed again after the injection
+        return gzip.compress(tag.sub(snippet + b'</body>', gzip.decompress(compressed)), 6)
+
+    compressed = gzip.compress(body, 6)
+    deflated = zlib.compress(body, 6)
+    for name, func in (
+            ('compression disabled', disabled),
+            ('gzip: decompress, inject, compress', recompress),
+            ('gzip: a trailer member', lambda: utils.inject_compressed(
+                compressed, 'gzip', snippet)),
+            ('deflate: streaming recompression', lambda: utils.inject_compressed(
+                deflated, 'deflate', snippet))):
+        seconds = timeit.timeit(func, number=number)
+        report('%s (%d KB sent)' % (name, len(func()) // 1024), seconds, number)
+
+
+def bench_injection(size=1024 * 1024, number=200):
+    """Injection of the toolbar into a plain HTML body."""
+    import jinja2
+
+    print("Injection into a %d KB HTML body, per response:" % (size // 1024))
+    body = html_page(size)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(
+        op.join(op.dirname(utils.__file__), 'templates')))
+    template = env.get_template('debugtoolbar/inject.html')
+
+    def before():
+        # Render the template per response, search the tag and substitute it
+        utils.RE_BODY.search(body)
+        html = template.render(static_path='/_debug/static', toolbar_url='/_debug/' + 'f' * 32)
+        return utils.RE_BODY.sub(html.encode('utf-8') + b'</body>', body)
+
+    snippet = utils.Snippet(template.render(
+        static_path='/_debug/static', toolbar_url='/_debug/' + utils.Snippet.SLOT))
+
+    def after():
+        # Find the tag, render the precompiled snippet and copy the body once
+        position = utils.find_body_end(body)
+        view = memoryview(body)
+        return b''.join((view[:position], snippet.render('f' * 32), view[position:]))
+
+    assert before() == after()
+    report('render template, search and sub (before)', timeit.timeit(
+        before, number=number), number)
+    report('precompiled snippet, find and join (after)', timeit.timeit(
+        after, number=number), number)
+
+    report('  search: RE_BODY.search', timeit.timeit(
+        lambda: utils.RE_BODY.search(body), number=number), number)
+    report('  search: find_body_end', timeit.timeit(
+        lambda: utils.find_body_end(body), number=number), number)
+    report('  snippet: render template', timeit.timeit(
+        lambda: template.render(static_path='/_debug/static', toolbar_url='/_debug/1'),
+        number=number), number)
+    report('  snippet: precompiled', timeit.timeit(
+        lambda: snippet.render('f' * 32), number=number), number)
+
+
+def bench_route_performance(number=100000):
+    """Recording a request's latency per route."""
+    print("Route performance, per request:")
+
+    durations = []
+    report('append to a list (no percentiles)', timeit.timeit(
+        lambda: durations.append(0.0123), number=number), number)
+
+    performance = utils.RoutePerformance()
+    report('log-linear histogram', timeit.timeit(
+        lambda: performance.record('index', 0.0123, 200), number=number), number)
+
+    print("Route performance, percentiles of %d requests:" % number)
+    durations = [random.expovariate(100) for _ in range(number)]
+    report('sort the durations', timeit.timeit(
+        lambda: sorted(durations)[int(len(durations) * 0.99)], number=10), 10)
+    report('merge the window histograms', timeit.timeit(
+        lambda: performance.summary(900), number=10), 10)
+
+
+BENCHMARKS = {
+    name[6:]: func for name, func in globals().items() if name.startswith('bench_')
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
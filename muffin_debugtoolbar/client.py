@@ -0,0 +1,186 @@
+"""Outgoing HTTP requests tracking.
+
+The requests of `aiohttp.ClientSession` are traced with `aiohttp.TraceConfig` (aiohttp>=3.0)
+only for the captured requests (see `HTTP_CALLS`). The trace config is added to the sessions
+created after the application starts, an existing session could be registered: ::
+
+    app.ps.debugtoolbar.http_client.register(session)
+
+"""
+import asyncio
+import time
+
+from .utils import HTTP_CALLS
+
+try:
+    import aiohttp
+    TraceConfig = aiohttp.TraceConfig
+except (ImportError, AttributeError):  # aiohttp<3.0
+    aiohttp = TraceConfig = None
+
+
+class HTTPCall:
+
+    """A traced outgoing request."""
+
+    __slots__ = 'method', 'url', 'status', 'error', 'task', 'started', 'dns', 'connect', \
+        'headers', 'finished', 'reused', 'sent', 'received'
+
+    def __init__(self, method, url, task):
+        self.method = method
+        self.url = url
+        self.task = task
+        self.status = self.error = None
+        self.started = time.perf_counter()
+        self.dns = self.connect = None
+        self.headers = self.finished = None
+        self.reused = None
+        self.sent = self.received = 0
+
+    @property
+    def duration(self):
+        """Total time of the call."""
+        return (self.finished or self.headers or time.perf_counter()) - self.started
+
+    def phases(self):
+        """Split the call into phases: dns, connect, ttfb, transfer (in seconds)."""
+        dns = self.dns and self.dns[1] and self.dns[1] - self.dns[0]
+        connect = self.connect and self.connect[1] and \
+            self.connect[1] - self.connect[0] - (dns or 0)
+        ready = self.connect and self.connect[1] or self.started
+        ttfb = self.headers and self.headers - ready
+        transfer = self.headers and self.finished and self.finished - self.headers
+        return dns, connect, ttfb, transfer
+
+
+def sequential(calls):
+    """Find the calls made one after another by the same task.
+
+    Such calls could possibly be run concurrently (`asyncio.gather`).
+
+    :return: A list of chains: (calls, the chain's time, the longest call's time)
+    """
+    chains = []
+    last = {}
+    for call in sorted(calls, key=lambda call: call.started):
+        chain = last.get(call.task)
+        previous = chain and chain[-1]
+        if previous and previous.started + previous.duration <= call.started:
+            chain.append(call)
+            continue
+        chain = last[call.task] = [call]
+        chains.append(chain)
+
+    return [
+        (chain, chain[-1].started + chain[-1].duration - chain[0].started,
+         max(call.duration for call in chain))
+        for chain in chains if len(chain) > 1
+    ]
+
+
+class ClientTracer:
+
+    """Trace `aiohttp.ClientSession` requests."""
+
+    def __init__(self):
+        self.trace_config = None
+        self._init = None
+
+    @property
+    def supported(self):
+        return TraceConfig is not None
+
+    def install(self):
+        """Add the trace config to the sessions which will be created."""
+        if not self.supported or self._init is not None:
+            return
+
+        trace_config = self.trace_config = TraceConfig()
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_dns_resolvehost_start.append(self.on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(self.on_dns_resolvehost_end)
+        trace_config.on_connection_create_start.append(self.on_connection_create_start)
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        trace_config.on_request_chunk_sent.append(self.on_request_chunk_sent)
+        trace_config.on_response_chunk_received.append(self.on_response_chunk_received)
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_request_exception.append(self.on_request_exception)
+        trace_config.freeze()
+
+        init = self._init = aiohttp.ClientSession.__init__
+
+        def __init__(session, *args, trace_configs=None, **kwargs):
+            trace_configs = list(trace_configs or ())
+            trace_configs.append(trace_config)
+            init(session, *args, trace_configs=trace_configs, **kwargs)
+
+        aiohttp.ClientSession.__init__ = __init__
+
+    def uninstall(self):
+        """Restore the sessions' initialization."""
+        if self._init is not None:
+            aiohttp.ClientSession.__init__, self._init = self._init, None
+
+    def register(self, session):
+        """Trace the session created before the application has been started."""
+        if self.trace_config is not None and self.trace_config not in session._trace_configs:
+            session._trace_configs.append(self.trace_config)
+
+    @staticmethod
+    async def on_request_start(session, ctx, params):
+        calls = HTTP_CALLS.get()
+        if calls is None:
+            ctx.call = None
+            return
+        ctx.call = HTTPCall(params.method, str(params.url), id(asyncio.current_task()))
+        calls.append(ctx.call)
+
+    @staticmethod
+    async def on_dns_resolvehost_start(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.dns = [time.perf_counter(), None]
+
+    @staticmethod
+    async def on_dns_resolvehost_end(session, ctx, params):
+        if ctx.call is not None and ctx.call.dns:
+            ctx.call.dns[1] = time.perf_counter()
+
+    @staticmethod
+    async def on_connection_create_start(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.connect = [time.perf_counter(), None]
+            ctx.call.reused = False
+
+    @staticmethod
+    async def on_connection_create_end(session, ctx, params):
+        if ctx.call is not None and ctx.call.connect:
+            ctx.call.connect[1] = time.perf_counter()
+
+    @staticmethod
+    async def on_connection_reuseconn(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.reused = True
+
+    @staticmethod
+    async def on_request_chunk_sent(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.sent += len(params.chunk)
+
+    @staticmethod
+    async def on_response_chunk_received(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.received += len(params.chunk)
+            ctx.call.finished = time.perf_counter()
+
+    @staticmethod
+    async def on_request_end(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.headers = time.perf_counter()
+            ctx.call.status = params.response.status
+
+    @staticmethod
+    async def on_request_exception(session, ctx, params):
+        if ctx.call is not None:
+            ctx.call.finished = time.perf_counter()
+            ctx.call.error = repr(params.exception)
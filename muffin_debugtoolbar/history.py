@@ -0,0 +1,319 @@
+"""Requests history.
+
+A captured request's state is frozen into a compact snapshot when the response is processed.
+The snapshots keep only plain data (no links to the request, panels, frames) and are stored
+in a history bounded by their total size.
+
+The history backends:
+
+* `memory` -- the process' memory (default);
+* `sqlite:///path/to/history.db` -- a SQLite database in WAL mode. The history is shared
+  between worker processes and survives restarts.
+
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from .utils import sizeof
+
+
+logger = logging.getLogger(__name__)
+
+
+class PanelSnapshot:
+
+    """A frozen panel."""
+
+    __slots__ = 'name', 'dom_id', 'title', 'nav_title', 'has_content', 'template', 'context', \
+        'app'
+
+    def __init__(self, name, dom_id, title, nav_title, has_content, template, context,
+                 app=None):
+        self.name = name
+        self.dom_id = dom_id
+        self.title = title
+        self.nav_title = nav_title
+        self.has_content = has_content
+        self.template = template
+        self.context = context
+        self.app = app
+
+    @classmethod
+    def from_panel(cls, panel):
+        """Freeze the given panel."""
+        has_content = bool(panel.has_content)
+        return cls(
+            panel.name, panel.dom_id, panel.title, panel.nav_title, has_content,
+            panel.template, has_content and panel.render_vars() or {}, panel.app)
+
+    @property
+    def size(self):
+        """Estimate the snapshot's size in bytes."""
+        return sizeof((self.name, self.title, self.nav_title, self.template, self.context))
+
+    def to_dict(self):
+        """Serialize the snapshot."""
+        return {
+            'name': self.name, 'dom_id': self.dom_id, 'title': self.title,
+            'nav_title': self.nav_title, 'has_content': self.has_content,
+            'template': self.template if isinstance(self.template, str) else None,
+            'context': self.context,
+        }
+
+    def render_content(self):
+        """Render the panel's content."""
+        if not self.has_content:
+            return ""
+        template = self.template
+        if isinstance(template, str):
+            template = self.app.ps.jinja2.env.get_template(template)
+        return template.render(app=self.app, request=None, **self.context)
+
+
+class StateSnapshot:
+
+    """A frozen request's state."""
+
+    __slots__ = 'id', 'method', 'path', 'scheme', 'status', 'route', 'duration', 'panels', \
+        'size'
+
+    def __init__(self, id, method, path, scheme, status, route, duration, panels):
+        self.id = id
+        self.method = method
+        self.path = path
+        self.scheme = scheme
+        self.status = status
+        self.route = route
+        self.duration = duration
+        self.panels = panels
+        self.size = sizeof((id, method, path, scheme, route)) + sum(p.size for p in panels)
+
+    @property
+    def json(self):
+        """Return JSON."""
+        return {'method': self.method,
+                'path': self.path,
+                'scheme': self.scheme,
+                'status_code': self.status}
+
+    def dumps(self):
+        """Serialize the snapshot."""
+        return json.dumps({
+            'id': self.id, 'method': self.method, 'path': self.path, 'scheme': self.scheme,
+            'status': self.status, 'route': self.route, 'duration': self.duration,
+            'panels': [panel.to_dict() for panel in self.panels],
+        }, default=str)
+
+    @classmethod
+    def loads(cls, data, app=None):
+        """Deserialize the snapshot."""
+        data = json.loads(data)
+        data['panels'] = [PanelSnapshot(app=app, **panel) for panel in data['panels']]
+        return cls(**data)
+
+
+class MemoryHistory(OrderedDict):
+
+    """ Store snapshots in memory and evict the oldest ones by the total size. """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        """ Save the budget. """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        super(MemoryHistory, self).__init__()
+
+    def __setitem__(self, key, snapshot):
+        """ Evict the oldest snapshots if needed. """
+        if key in self:
+            del self[key]
+        super(MemoryHistory, self).__setitem__(key, snapshot)
+        self.bytes += snapshot.size
+        while self.bytes > self.max_bytes and len(self) > 1:
+            del self[next(iter(self))]
+
+    def __delitem__(self, key):
+        """ Account the removed snapshot. """
+        self.bytes -= self[key].size
+        super(MemoryHistory, self).__delitem__(key)
+
+
+class SQLiteHistory:
+
+    """ Store snapshots in a SQLite database (in WAL mode).
+
+    Several processes could share the database. The oldest snapshots are evicted by the total
+    size of the serialized snapshots (the size is kept up to date by triggers).
+
+    The snapshots are written by a background thread, so the event loop isn't blocked by the
+    database's locks. The queued snapshots are available to read meanwhile.
+
+    """
+
+    SCHEMA = """
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS history_size (bytes INTEGER NOT NULL);
+        INSERT INTO history_size SELECT COALESCE(SUM(size), 0) FROM history
+            WHERE NOT EXISTS (SELECT 1 FROM history_size);
+        CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history
+            BEGIN UPDATE history_size SET bytes = bytes + NEW.size; END;
+        CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history
+            BEGIN UPDATE history_size SET bytes = bytes - OLD.size; END;
+        COMMIT;
+    """
+
+    def __init__(self, path, max_bytes=32 * 1024 * 1024, app=None):
+        """ Save the params. The database is connected lazily (after workers are forked). """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.app = app
+        self.pending = OrderedDict()
+        self._conn = None
+        self._pid = None
+        self._queue = None
+        self._writer_pid = None
+
+    def connect(self):
+        """ Open a connection and create the schema if needed. """
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    @property
+    def conn(self):
+        """ Get a connection to read for the current process. """
+        if self._pid != os.getpid():
+            self._conn = self.connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def __setitem__(self, key, snapshot):
+        """ Queue the snapshot to be stored by the writer thread. """
+        self.pending[key] = snapshot
+        if self._writer_pid != os.getpid():
+            self._queue = queue.Queue()
+            threading.Thread(target=self.write, name='debugtoolbar-history', daemon=True).start()
+            self._writer_pid = os.getpid()
+        self._queue.put(key)
+
+    def write(self):
+        """ Store the queued snapshots (it's run in the writer thread). """
+        conn = self.connect()
+        while True:
+            key = self._queue.get()
+            try:
+                if key is None:
+                    conn.close()
+                    return
+
+                snapshot = self.pending.get(key)
+                if snapshot is not None:
+                    self.store(conn, key, snapshot)
+                    if self.pending.get(key) is snapshot:
+                        del self.pending[key]
+            except Exception:  # noqa, keep the writer running
+                logger.exception('Failed to store the request %s', key)
+                self.pending.pop(key, None)
+            finally:
+                self._queue.task_done()
+
+    def store(self, conn, key, snapshot):
+        """ Store the snapshot and evict the oldest ones if needed. """
+        data = snapshot.dumps()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM history WHERE id = ?', (key,))
+            conn.execute(
+                'INSERT INTO history (id, size, data) VALUES (?, ?, ?)', (key, len(data), data))
+
+            total, = conn.execute('SELECT bytes FROM history_size').fetchone()
+            if total > self.max_bytes:
+                seq = None
+                for seq, size in conn.execute('SELECT seq, size FROM history ORDER BY seq'):
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+                conn.execute(
+                    'DELETE FROM history WHERE seq <= ? AND seq < (SELECT MAX(seq) FROM history)',
+                    (seq,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def flush(self):
+        """ Wait for the queued snapshots to be stored. """
+        if self._queue is not None and self._writer_pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        """ Store the queued snapshots and stop the writer. """
+        if self._queue is not None and self._writer_pid == os.getpid():
+            self._queue.put(None)
+            self._queue.join()
+            self._writer_pid = None
+
+    def __getitem__(self, key):
+        """ Load the snapshot. """
+        snapshot = self.pending.get(key)
+        if snapshot is not None:
+            return snapshot
+        row = self.conn.execute('SELECT data FROM history WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return StateSnapshot.loads(row[0], self.app)
+
+    def get(self, key, default=None):
+        """ Load the snapshot if it exists. """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __delitem__(self, key):
+        self.pending.pop(key, None)
+        self.conn.execute('DELETE FROM history WHERE id = ?', (key,))
+
+    def __contains__(self, key):
+        return key in self.pending or self.conn.execute(
+            'SELECT 1 FROM history WHERE id = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM history').fetchone()[0] + len(
+            self.pending)
+
+    def __iter__(self):
+        """ Iterate the ids from the oldest. """
+        pending = list(self.pending)
+        for row in self.conn.execute('SELECT id FROM history ORDER BY seq'):
+            if row[0] not in pending:
+                yield row[0]
+        yield from pending
+
+    def __reversed__(self):
+        """ Iterate the ids from the newest. """
+        pending = list(self.pending)[::-1]
+        yield from pending
+        for row in self.conn.execute('SELECT id FROM history ORDER BY seq DESC'):
+            if row[0] not in pending:
+                yield row[0]
+
+
+def create_history(backend='memory', max_bytes=32 * 1024 * 1024, app=None):
+    """ Create a history by the backend's URI. """
+    if backend == 'memory':
+        return MemoryHistory(max_bytes)
+
+    if backend.startswith('sqlite://'):
+        return SQLiteHistory(backend[len('sqlite://'):], max_bytes, app)
+
+    raise ValueError('Unsupported history backend: %s' % backend)
@@ -1,10 +1,13 @@
 """Debug panels."""
-import asyncio
 import datetime as dt
-import logging
 import os
 import platform
 import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict, deque
 from html import escape
 from operator import itemgetter
 from pprint import saferepr
@@ -12,8 +15,18 @@ from pprint import saferepr
 import pkg_resources
 from muffin import __version__ as muffin_version
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 from .tbtools.tbtools import Traceback
-from .utils import LoggingTrackingHandler
+from .history import PanelSnapshot
+from .client import sequential
+from .sql import repeated
+from .utils import (
+    CURRENT_STATE, GC_COLLECTIONS, HTTP_CALLS, LOG_RECORDS, MIDDLEWARE_TIMINGS, QUERIES, TASKS,
+    TEMPLATES, flamegraph, route_name)
 
 
 class DebugPanel:
@@ -49,11 +62,25 @@ class DebugPanel:
         """Wrap handler to additional logic layer."""
         return handler
 
-    @asyncio.coroutine
-    def process_response(self, response):
+    async def process_response(self, response):
         """Process a response."""
         pass
 
+    def cleanup(self):
+        """Release the resources acquired in `wrap_handler`.
+
+        It's always called when the request is finished, even when the response hasn't been
+        processed (an exception is re-raised, the request is cancelled).
+        """
+        pass
+
+    def freeze(self):
+        """Freeze the panel into a compact snapshot (it's called after processing response).
+
+        The snapshot shouldn't keep any links to the request and the panel.
+        """
+        return PanelSnapshot.from_panel(self)
+
     def render_content(self):
         """Render the panel's content."""
         if not self.has_content:
@@ -84,8 +111,7 @@ class HeaderDebugPanel(DebugPanel):
         self.request_headers = [(k, v) for k, v in sorted(request.headers.items())]
         self.response_headers = None
 
-    @asyncio.coroutine
-    def process_response(self, response):
+    async def process_response(self, response):
         """Store response headers."""
         self.response_headers = [(k, v) for k, v in sorted(response.headers.items())]
 
@@ -192,23 +218,33 @@ class MiddlewaresDebugPanel(DebugPanel):
 
     def render_vars(self):
         """Provide template's context."""
-        return {'middlewares': self.middlewares}
+        stats = self.app.ps.debugtoolbar.middleware_stats
+        return {
+            'middlewares': self.middlewares,
+            'stats': {
+                name: {'count': s.count, 'avg': s.avg * 1000, 'max': s.max * 1000}
+                for name, s in stats.items()
+            },
+        }
 
 
 class RequestVarsDebugPanel(DebugPanel):
     name = 'Request Vars'
     template = 'debugtoolbar/panels/request_vars.html'
 
-    @asyncio.coroutine
-    def process_response(self, response):
+    def __init__(self, app, request=None):
+        super(RequestVarsDebugPanel, self).__init__(app, request)
+        self.data = {}
+
+    async def process_response(self, response):
         request = self.request
-        yield from request.post()
+        await request.post()
         self.data = {
             'get': [(k, request.GET.getall(k)) for k in request.GET],
             'post': [(k, saferepr(v)) for k, v in request.POST.items()],
             'cookies': [(k, request.cookies.get(k)) for k in request.cookies],
             'session': [(k, saferepr(v)) for k, v in getattr(request, 'session', {}).items()],
-            'attrs': [(k, v) for k, v in request.items()],
+            'attrs': [(k, saferepr(v)) for k, v in request.items()],
         }
 
     def render_vars(self):
@@ -254,33 +290,930 @@ class LoggingDebugPanel(DebugPanel):
 
     def __init__(self, app, request=None):
         super(LoggingDebugPanel, self).__init__(app, request)
-        self.handler = LoggingTrackingHandler()
+        self.records = deque(maxlen=100)
+        self._token = None
 
     @property
     def nav_title(self):
         """ Get a navigation title. """
-        return "%s (%s) " % (self.title, len(self.handler.records))
+        return "%s (%s) " % (self.title, len(self.records))
 
     @property
     def has_content(self):
-        return self.handler.records
+        return self.records
 
     def wrap_handler(self, handler, context_switcher):
-        context_switcher.add_context_in(lambda: logging.root.addHandler(self.handler))
-        context_switcher.add_context_out(lambda: logging.root.removeHandler(self.handler))
+        """Route log records of the request's context to the panel."""
+        self._token = LOG_RECORDS.set(self.records)
         return handler
 
+    async def process_response(self, response):
+        """Stop tracking log records."""
+        self.cleanup()
+
+    def cleanup(self):
+        """Stop tracking log records."""
+        if self._token is not None:
+            LOG_RECORDS.reset(self._token)
+            self._token = None
+
     def render_vars(self):
         return {
             'records': [
                 {
-                    'message': record.getMessage(),
+                    'message': record.message,
                     'time': dt.datetime.fromtimestamp(record.created).strftime('%H:%M:%S'),
-                    'level': record.levelname,
+                    'level': record.level,
                     'file': os.path.relpath(record.pathname),
                     'file_long': record.pathname,
                     'line': record.lineno,
-                } for record in self.handler.records
+                } for record in self.records
+            ]
+        }
+
+
+class TimingDebugPanel(DebugPanel):
+
+    """Split the request's wall time into on-CPU and suspended (awaiting) time."""
+
+    name = 'Timing'
+    template = 'debugtoolbar/panels/timing.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the counters."""
+        super(TimingDebugPanel, self).__init__(app, request)
+        self.started = time.perf_counter()
+        self.finished = None
+        self.cpu_time = 0.0
+        self.process_time = 0.0
+        self.switches = 0
+        self._switched_in = None
+        self._process_in = None
+
+    @property
+    def wall_time(self):
+        """Total time of the request."""
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def suspended_time(self):
+        """Time the handler has been waiting for I/O."""
+        return max(self.wall_time - self.cpu_time, 0.0)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        return "%s (%.2f ms)" % (self.title, self.wall_time * 1000)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Track context switches."""
+        context_switcher.add_context_in(self.context_in)
+        context_switcher.add_context_out(self.context_out)
+        return handler
+
+    def context_in(self):
+        """The handler is resumed."""
+        if self._process_in is not None:
+            self.switches += 1
+        self._switched_in = time.perf_counter()
+        self._process_in = time.process_time()
+
+    def context_out(self):
+        """The handler is suspended (or finished)."""
+        if self._switched_in is None:
+            return
+        self.finished = time.perf_counter()
+        self.cpu_time += self.finished - self._switched_in
+        self.process_time += time.process_time() - self._process_in
+        self._switched_in = None
+
+    async def process_response(self, response):
+        """Close the last on-CPU interval (the handler could raise an exception)."""
+        self.context_out()
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'wall_time': self.wall_time * 1000,
+            'cpu_time': self.cpu_time * 1000,
+            'suspended_time': self.suspended_time * 1000,
+            'process_time': self.process_time * 1000,
+            'switches': self.switches,
+        }
+
+
+class ResourcesDebugPanel(DebugPanel):
+
+    """System resources used by the request while its handler is on-CPU (`getrusage`).
+
+    The usage is measured for the event loop's thread (or for the whole process when
+    `RUSAGE_THREAD` isn't supported, then the toolbar's threads are counted too). It takes two
+    `getrusage` calls per step of the handler, so the panel isn't enabled by default.
+
+    """
+
+    name = 'Resources'
+    template = 'debugtoolbar/panels/resources.html'
+
+    #: (title, struct_rusage index, is a time)
+    FIELDS = (
+        ('User CPU time', 0, True),
+        ('System CPU time', 1, True),
+        ('Minor page faults', 6, False),
+        ('Major page faults', 7, False),
+        ('Block input operations', 9, False),
+        ('Block output operations', 10, False),
+        ('Voluntary context switches', 14, False),
+        ('Involuntary context switches', 15, False),
+    )
+
+    WHO = resource and getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+    def __init__(self, app, request=None):
+        """Initialize the counters."""
+        super(ResourcesDebugPanel, self).__init__(app, request)
+        self.usage = [0] * len(self.FIELDS)
+        self._usage_in = None
+
+    @property
+    def has_content(self):
+        return resource is not None
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if resource is None:
+            return self.title
+        return "%s (%.2f ms CPU)" % (self.title, (self.usage[0] + self.usage[1]) * 1000)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Measure the usage while the handler is on-CPU."""
+        if resource is not None:
+            context_switcher.add_context_in(self.context_in)
+            context_switcher.add_context_out(self.context_out)
+        return handler
+
+    def context_in(self):
+        """The handler is resumed."""
+        self._usage_in = resource.getrusage(self.WHO)
+
+    def context_out(self):
+        """The handler is suspended (or finished)."""
+        if self._usage_in is None:
+            return
+        usage, usage_in, self._usage_in = resource.getrusage(self.WHO), self._usage_in, None
+        for idx, (_, field, _) in enumerate(self.FIELDS):
+            self.usage[idx] += usage[field] - usage_in[field]
+
+    async def process_response(self, response):
+        """Close the last on-CPU interval (the handler could raise an exception)."""
+        if self._usage_in is not None:
+            self.context_out()
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'thread': self.WHO != resource.RUSAGE_SELF,
+            'usage': [
+                (title, value * 1000 if is_time else value, is_time)
+                for (title, _, is_time), value in zip(self.FIELDS, self.usage)
+            ],
+        }
+
+
+class MiddlewareTimingDebugPanel(DebugPanel):
+
+    """Time spent inside each middleware layer (excluding the inner handler)."""
+
+    name = 'Middlewares'
+    template = 'debugtoolbar/panels/middleware_timing.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the timings."""
+        super(MiddlewareTimingDebugPanel, self).__init__(app, request)
+        self.timings = OrderedDict()
+        self._token = None
+
+    @property
+    def has_content(self):
+        return bool(self.timings)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Collect the middlewares timings of the request's context."""
+        self._token = MIDDLEWARE_TIMINGS.set(self.timings)
+        return handler
+
+    async def process_response(self, response):
+        """Stop collecting the timings."""
+        self.cleanup()
+
+    def cleanup(self):
+        """Stop collecting the timings."""
+        if self._token is not None:
+            MIDDLEWARE_TIMINGS.reset(self._token)
+            self._token = None
+
+    def render_vars(self):
+        """Provide template's context."""
+        stats = self.app.ps.debugtoolbar.middleware_stats
+        return {
+            'timings': [
+                {
+                    'name': name,
+                    'total': total * 1000,
+                    'self': (total - inner) * 1000,
+                    'avg': stats[name].avg * 1000 if name in stats else None,
+                } for name, (total, inner) in self.timings.items()
+            ]
+        }
+
+
+def loop_block(block):
+    """Prepare the event loop's block to render."""
+    return {
+        'time': dt.datetime.fromtimestamp(block['time']).strftime('%H:%M:%S'),
+        'duration': block['duration'] and block['duration'] * 1000,
+        'request': block['request'],
+        'stack': block['stack'],
+    }
+
+
+class LoopBlocksDebugPanel(DebugPanel):
+
+    """The event loop's blocks happened while the request's handler was running."""
+
+    name = 'Blocking Calls'
+    template = 'debugtoolbar/panels/loop_blocks.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the blocks."""
+        super(LoopBlocksDebugPanel, self).__init__(app, request)
+        self.watchdog = app.ps.debugtoolbar.watchdog
+        self.blocks = []
+
+    @property
+    def has_content(self):
+        return bool(self.blocks)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if not self.blocks:
+            return self.title
+        return "%s (%d)" % (self.title, len(self.blocks))
+
+    def wrap_handler(self, handler, context_switcher):
+        """Mark the request as running for the watchdog."""
+        if self.watchdog is not None:
+            context_switcher.add_context_in(self.context_in)
+            context_switcher.add_context_out(self.context_out)
+        return handler
+
+    def context_in(self):
+        """The handler is resumed."""
+        self.watchdog.running = self
+
+    def context_out(self):
+        """The handler is suspended (a block could be finished)."""
+        self.watchdog.running = None
+        self.watchdog.finish()
+
+    async def process_response(self, response):
+        """Measure a block of the last step."""
+        if self.watchdog is not None:
+            self.watchdog.finish()
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'blocks': [loop_block(block) for block in self.blocks],
+            'threshold': self.watchdog.threshold * 1000,
+            'show_request': False,
+        }
+
+
+class TasksDebugPanel(DebugPanel):
+
+    """Tasks created by the request: spawned, finished and leaked ones."""
+
+    name = 'Tasks'
+    template = 'debugtoolbar/panels/tasks.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the records."""
+        super(TasksDebugPanel, self).__init__(app, request)
+        self.tracker = app.ps.debugtoolbar.tasks
+        self.started = time.perf_counter()
+        self.records = []
+        self._token = None
+
+    @property
+    def has_content(self):
+        return bool(self.records)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if not self.records:
+            return self.title
+        outlived = sum(1 for record in self.records if record.outlived)
+        if outlived:
+            return "%s (%d, %d outlived)" % (self.title, len(self.records), outlived)
+        return "%s (%d)" % (self.title, len(self.records))
+
+    def wrap_handler(self, handler, context_switcher):
+        """Record the tasks created in the request's context."""
+        self.tracker.install(self.app.loop)
+        self._token = TASKS.set(self.records)
+        return handler
+
+    async def process_response(self, response):
+        """Mark the pending tasks as outlived the response."""
+        self.cleanup()
+        for record in self.records:
+            if record.finished is None:
+                record.outlived = True
+
+    def cleanup(self):
+        """Stop recording the tasks."""
+        if self._token is not None:
+            TASKS.reset(self._token)
+            self._token = None
+            self.tracker.uninstall()
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'tasks': [
+                {
+                    'name': record.name,
+                    'site': record.site,
+                    'stack': record.stack,
+                    'created': (record.created - self.started) * 1000,
+                    'duration': record.finished and (record.finished - record.created) * 1000,
+                    'state': record.state,
+                    'outlived': record.outlived,
+                } for record in self.records
+            ]
+        }
+
+
+class GCDebugPanel(DebugPanel):
+
+    """Garbage collections triggered by the request."""
+
+    name = 'GC'
+    template = 'debugtoolbar/panels/gc.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the collections."""
+        super(GCDebugPanel, self).__init__(app, request)
+        self.tracker = app.ps.debugtoolbar.gc
+        self.collections = []
+        self._token = None
+
+    @property
+    def has_content(self):
+        return bool(self.collections)
+
+    @property
+    def pause(self):
+        """Total time of the collections."""
+        return sum(collection[3] for collection in self.collections)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if not self.collections:
+            return self.title
+        return "%s (%d, %.2f ms)" % (self.title, len(self.collections), self.pause * 1000)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Record the collections in the request's context."""
+        self.tracker.install()
+        self._token = GC_COLLECTIONS.set(self.collections)
+        return handler
+
+    async def process_response(self, response):
+        """Stop recording and account the pauses by the route."""
+        if self._token is not None:
+            self.cleanup()
+            self.tracker.add(route_name(self.request), self.collections)
+
+    def cleanup(self):
+        """Stop recording the collections."""
+        if self._token is not None:
+            GC_COLLECTIONS.reset(self._token)
+            self._token = None
+            self.tracker.uninstall()
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'pause': self.pause * 1000,
+            'collections': [
+                {
+                    'generation': generation,
+                    'collected': collected,
+                    'uncollectable': uncollectable,
+                    'duration': duration * 1000,
+                } for generation, collected, uncollectable, duration in self.collections
+            ],
+        }
+
+
+class SQLDebugPanel(DebugPanel):
+
+    """Database queries of the request (see `sql_adapters`)."""
+
+    name = 'SQL'
+    template = 'debugtoolbar/panels/sql.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the queries."""
+        super(SQLDebugPanel, self).__init__(app, request)
+        self.queries = []
+        self.explain_url = None
+        self._token = None
+
+    @property
+    def has_content(self):
+        return bool(self.queries)
+
+    @property
+    def duration(self):
+        """Total time of the queries."""
+        return sum(query.duration for query in self.queries)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        return "%s (%d, %.2f ms)" % (self.title, len(self.queries), self.duration * 1000)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Record the queries in the request's context."""
+        self._token = QUERIES.set(self.queries)
+        return handler
+
+    async def process_response(self, response):
+        """Stop recording."""
+        if self._token is None:
+            return
+
+        self.cleanup()
+        state = CURRENT_STATE.get()
+        if state is not None:
+            self.explain_url = '%s%s/explain/' % (self.app.ps.debugtoolbar.cfg.prefix, state.id)
+
+    def cleanup(self):
+        """Stop recording."""
+        if self._token is not None:
+            QUERIES.reset(self._token)
+            self._token = None
+
+    def render_vars(self):
+        """Provide template's context."""
+        explainable = self.app.ps.debugtoolbar.sql_adapters
+        return {
+            'duration': self.duration * 1000,
+            'explain_url': self.explain_url,
+            'repeated': repeated(self.queries),
+            'queries': [
+                {
+                    'adapter': query.adapter,
+                    'database': query.database,
+                    'sql': query.sql,
+                    'params': query.params,
+                    'duration': query.duration * 1000,
+                    'site': query.site,
+                    'stack': query.stack,
+                    'explain': bool(self.explain_url) and query.adapter in explainable,
+                } for query in self.queries
+            ],
+        }
+
+
+class HTTPClientDebugPanel(DebugPanel):
+
+    """Outgoing HTTP requests of the request (`aiohttp.ClientSession`).
+
+    The requests are traced with `aiohttp.TraceConfig`, which isn't available in the aiohttp
+    versions supported by Muffin, so the panel isn't enabled by default.
+
+    """
+
+    name = 'HTTP Client'
+    template = 'debugtoolbar/panels/http_client.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the calls."""
+        super(HTTPClientDebugPanel, self).__init__(app, request)
+        self.calls = []
+        self._token = None
+
+    @property
+    def has_content(self):
+        return bool(self.calls)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if not self.calls:
+            return self.title
+        return "%s (%d, %.2f ms)" % (
+            self.title, len(self.calls), sum(call.duration for call in self.calls) * 1000)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Record the calls in the request's context."""
+        self._token = HTTP_CALLS.set(self.calls)
+        return handler
+
+    async def process_response(self, response):
+        """Stop recording."""
+        self.cleanup()
+
+    def cleanup(self):
+        """Stop recording."""
+        if self._token is not None:
+            HTTP_CALLS.reset(self._token)
+            self._token = None
+
+    def render_vars(self):
+        """Provide template's context."""
+        started = self.calls and min(call.started for call in self.calls) or 0
+        calls = []
+        for call in self.calls:
+            dns, connect, ttfb, transfer = (
+                phase and phase * 1000 for phase in call.phases())
+            calls.append({
+                'method': call.method,
+                'url': call.url,
+                'status': call.status,
+                'error': call.error,
+                'offset': (call.started - started) * 1000,
+                'duration': call.duration * 1000,
+                'dns': dns,
+                'connect': connect,
+                'ttfb': ttfb,
+                'transfer': transfer,
+                'reused': call.reused,
+                'sent': call.sent,
+                'received': call.received,
+            })
+
+        return {
+            'calls': calls,
+            'sequential': [
+                {
+                    'calls': ['%s %s' % (call.method, call.url) for call in chain],
+                    'duration': duration * 1000,
+                    'longest': longest * 1000,
+                } for chain, duration, longest in sequential(self.calls)
+            ],
+        }
+
+
+class TemplatesDebugPanel(DebugPanel):
+
+    """Templates rendered by the request (the toolbar's ones are excluded)."""
+
+    name = 'Templates'
+    template = 'debugtoolbar/panels/templates.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the records."""
+        super(TemplatesDebugPanel, self).__init__(app, request)
+        self.records = []
+        self._token = None
+
+    @property
+    def has_content(self):
+        return bool(self.records)
+
+    @property
+    def duration(self):
+        """Total time of the rendering."""
+        return sum(record.duration or 0 for record in self.records)
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if not self.records:
+            return self.title
+        return "%s (%d, %.2f ms)" % (self.title, len(self.records), self.duration * 1000)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Record the templates in the request's context."""
+        self._token = TEMPLATES.set(self.records)
+        return handler
+
+    async def process_response(self, response):
+        """Stop recording."""
+        self.cleanup()
+
+    def cleanup(self):
+        """Stop recording."""
+        if self._token is not None:
+            TEMPLATES.reset(self._token)
+            self._token = None
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'duration': self.duration * 1000,
+            'records': [
+                {
+                    'name': record.name,
+                    'duration': record.duration and record.duration * 1000,
+                    'keys': record.keys,
+                    'size': record.size,
+                    'templates': [
+                        (name, compiled, duration * 1000)
+                        for name, compiled, duration in record.templates
+                    ],
+                } for record in self.records
+            ]
+        }
+
+
+class ProfilerDebugPanel(DebugPanel):
+
+    """A statistical profiler.
+
+    The event loop's stack is sampled by a background thread only while the request's handler
+    is on-CPU. The samples are shown as a flamegraph.
+
+    """
+
+    name = 'Profiler'
+    template = 'debugtoolbar/panels/profiler.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the samples."""
+        super(ProfilerDebugPanel, self).__init__(app, request)
+        self.sampler = app.ps.debugtoolbar.sampler
+        self.samples = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        return "%s (%s)" % (self.title, sum(self.copy_samples().values()))
+
+    @property
+    def has_content(self):
+        return bool(self.samples)
+
+    def wrap_handler(self, handler, context_switcher):
+        """Sample the stack only while the handler is on-CPU."""
+        context_switcher.add_context_in(lambda: self.sampler.activate(self.add_sample))
+        context_switcher.add_context_out(lambda: self.sampler.deactivate(self.add_sample))
+        return handler
+
+    def add_sample(self, stack):
+        """Store a collapsed stack (it's called from the sampler's thread)."""
+        with self._lock:
+            self.samples[stack] += 1
+
+    def copy_samples(self):
+        """Copy the samples (a late sample could be added meanwhile)."""
+        with self._lock:
+            return self.samples.copy()
+
+    async def process_response(self, response):
+        """Stop sampling (the handler could raise an exception)."""
+        self.cleanup()
+
+    def cleanup(self):
+        """Stop sampling."""
+        self.sampler.deactivate(self.add_sample)
+
+    def render_vars(self):
+        """Provide template's context."""
+        samples = self.copy_samples()
+        return {
+            'interval': self.sampler.interval * 1000,
+            'total': sum(samples.values()),
+            'flamegraph': flamegraph(samples),
+            'collapsed': sorted(samples.items(), key=lambda s: s[1], reverse=True),
+        }
+
+
+class MemoryDebugPanel(DebugPanel):
+
+    """Memory allocated by the request.
+
+    Allocations are traced with `tracemalloc` from the handler's start to the response. The
+    tracing is expensive, so the panel isn't enabled by default. Concurrent requests share the
+    traced memory, so the numbers are precise only for sequential requests. Without tracing
+    only the allocated blocks are counted.
+
+    """
+
+    name = 'Memory'
+    template = 'debugtoolbar/panels/memory.html'
+
+    def __init__(self, app, request=None):
+        """Initialize the counters."""
+        super(MemoryDebugPanel, self).__init__(app, request)
+        self.tracer = app.ps.debugtoolbar.memory
+        self.top = app.ps.debugtoolbar.cfg.memory_top
+        self.tracing = False
+        self.blocks = self.size = self.peak = None
+        self.sites = []
+        self._blocks = self._size = self._snapshot = None
+        self._started = False
+
+    @property
+    def nav_title(self):
+        """Get a navigation title."""
+        if self.size is not None:
+            return "%s (%+.1f KB)" % (self.title, self.size / 1024)
+        if self.blocks is not None:
+            return "%s (%+d blocks)" % (self.title, self.blocks)
+        return self.title
+
+    def wrap_handler(self, handler, context_switcher):
+        """Take the first snapshot."""
+        self.tracing = self.tracer.start()
+        self._started = True
+        if self.tracing:
+            self._snapshot = self.tracer.snapshot()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self._size = tracemalloc.get_traced_memory()[0]
+        self._blocks = sys.getallocatedblocks()
+        return handler
+
+    async def process_response(self, response):
+        """Take the second snapshot and compare them."""
+        if self._blocks is None:
+            return
+
+        self.blocks = sys.getallocatedblocks() - self._blocks
+        self._blocks = None
+        if self.tracing:
+            size, peak = tracemalloc.get_traced_memory()
+            self.size, self.peak = size - self._size, max(peak - self._size, 0)
+            stats = self.tracer.snapshot().compare_to(self._snapshot, 'lineno')
+            self.sites = [
+                (stat.traceback[0].filename, stat.traceback[0].lineno, stat.size_diff,
+                 stat.count_diff) for stat in stats[:self.top] if stat.size_diff
+            ]
+        self.cleanup()
+
+    def cleanup(self):
+        """Stop tracing after the last captured request."""
+        self._snapshot = None
+        if self._started:
+            self._started = False
+            self.tracer.stop()
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'tracing': self.tracing,
+            'blocks': self.blocks,
+            'size': self.size,
+            'peak': self.peak,
+            'sites': self.sites,
+        }
+
+
+class BudgetDebugPanel(DebugPanel):
+
+    """Show the toolbar's own cost and the capture throttling state."""
+
+    name = 'Capture Budget'
+    template = 'debugtoolbar/panels/budget.html'
+
+    def render_vars(self):
+        """Provide template's context."""
+        budget = self.app.ps.debugtoolbar.budget
+        budget.update()
+        return {
+            'enabled': budget.enabled,
+            'max_overhead': budget.max_overhead * 100,
+            'max_lag': budget.max_lag * 1000,
+            'overhead': budget.overhead * 100,
+            'lag': budget.last_lag * 1000,
+            'skip': budget.skip,
+            'allowed': budget.allowed,
+            'throttled': budget.throttled,
+            'total_spent': budget.total_spent * 1000,
+        }
+
+
+class CountersDebugPanel(DebugPanel):
+
+    """Count the captured requests which haven't been kept in the history."""
+
+    name = 'Request Counters'
+    template = 'debugtoolbar/panels/counters.html'
+
+    def render_vars(self):
+        """Provide template's context."""
+        debugtoolbar = self.app.ps.debugtoolbar
+        return {
+            'threshold': debugtoolbar.retention.threshold,
+            'counters': [
+                {
+                    'route': route,
+                    'count': count,
+                    'avg': total / count * 1000,
+                    'max': max_ * 1000,
+                    'threshold': debugtoolbar.retention.routes.get(
+                        route, debugtoolbar.retention.threshold),
+                } for route, (count, total, max_) in debugtoolbar.counters.items()
+            ]
+        }
+
+
+class RoutePerformanceDebugPanel(DebugPanel):
+
+    """Latency percentiles, throughput and error rates of all the requests per route."""
+
+    name = 'Route Performance'
+    template = 'debugtoolbar/panels/performance.html'
+
+    def render_vars(self):
+        """Provide template's context."""
+        performance = self.app.ps.debugtoolbar.performance
+        if performance is None:
+            return {'windows': []}
+        return {
+            'windows': [
+                (seconds, performance.summary(seconds)) for seconds in performance.windows
+            ]
+        }
+
+
+class LoopWatchdogDebugPanel(DebugPanel):
+
+    """The worst blocks of the event loop."""
+
+    name = 'Loop Blocks'
+    template = 'debugtoolbar/panels/loop_blocks.html'
+
+    def render_vars(self):
+        """Provide template's context."""
+        watchdog = self.app.ps.debugtoolbar.watchdog
+        if watchdog is None:
+            return {'blocks': None}
+        return {
+            'blocks': [loop_block(block) for block in watchdog.blocks()],
+            'total': watchdog.total,
+            'threshold': watchdog.threshold * 1000,
+            'show_request': True,
+        }
+
+
+class PendingTasksDebugPanel(DebugPanel):
+
+    """The captured requests' tasks which are still pending, grouped by creation site."""
+
+    name = 'Pending Tasks'
+    template = 'debugtoolbar/panels/pending_tasks.html'
+
+    def render_vars(self):
+        """Provide template's context."""
+        now = time.perf_counter()
+        sites = {}
+        for record in list(self.app.ps.debugtoolbar.tasks.pending.values()):
+            site = sites.get(record.site)
+            if site is None:
+                site = sites[record.site] = {
+                    'site': record.site, 'count': 0, 'age': 0.0, 'names': Counter(),
+                    'stack': record.stack}
+            site['count'] += 1
+            site['age'] = max(site['age'], now - record.created)
+            site['names'][record.name] += 1
+
+        return {'sites': sorted(sites.values(), key=itemgetter('count'), reverse=True)}
+
+
+class GCPausesDebugPanel(DebugPanel):
+
+    """Garbage collection pauses of the captured requests per route."""
+
+    name = 'GC Pauses'
+    template = 'debugtoolbar/panels/gc_pauses.html'
+
+    def render_vars(self):
+        """Provide template's context."""
+        return {
+            'pauses': [
+                {
+                    'route': route,
+                    'count': count,
+                    'total': total * 1000,
+                    'avg': total / count * 1000,
+                    'max': max_ * 1000,
+                } for route, (count, total, max_) in sorted(
+                    self.app.ps.debugtoolbar.gc.pauses.items(),
+                    key=lambda item: item[1][1], reverse=True)
             ]
         }
 
@@ -1,57 +1,105 @@
 """Debug Toolbar Plugin."""
 import asyncio
 import importlib
-import ipaddress as ip
+import logging
 import os.path as op
-import re
 import sys
+import time
 import uuid
+from collections import OrderedDict
 
 from muffin import (
-    Response, StaticRoute, HTTPException, HTTPBadRequest, to_coroutine, HTTPForbidden)
+    Response, StreamResponse, StaticRoute, HTTPException, HTTPBadRequest, to_coroutine,
+    HTTPForbidden, HTTPNotFound)
 from muffin.plugins import BasePlugin, PluginException
 from muffin.utils import json
 
-from . import panels, utils
+from . import client, panels, sql, utils
+from .history import StateSnapshot, create_history
 from .tbtools.tbtools import get_traceback
 
 
-RE_BODY = re.compile(b'<\/body>', re.I)
 U_SSE_PAYLOAD = "id: {0}\nevent: new_request\ndata: {1}\n\n"
 REDIRECT_CODES = (300, 301, 302, 303, 305, 307, 308)
+# A status of the cancelled requests (the client has closed the connection)
+CLIENT_CLOSED_REQUEST = 499
 
 
 PLUGIN_ROOT = op.dirname(op.abspath(__file__))
 
+logger = logging.getLogger(__name__)
 
-@asyncio.coroutine
-def debugtoolbar_middleware_factory(app, handler):
+
+async def debugtoolbar_middleware_factory(app, handler):
     """Setup Debug middleware."""
     dbtb = app.ps.debugtoolbar
 
-    @asyncio.coroutine
-    def debugtoolbar_middleware(request):
+    async def debugtoolbar_middleware(request):
         """Integrate to application."""
+        if not dbtb.cfg.enabled:
+            return await handler(request)
+
+        # Measure all the requests except the toolbar's own ones
+        route = utils.route_name(request)
+        if dbtb.performance is None or route.startswith('debugtoolbar.'):
+            return await capture_request(request)
+
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await capture_request(request)
+            status = response.status
+            return response
+        except HTTPException as exc:
+            status = exc.status
+            raise
+        except asyncio.CancelledError:
+            status = CLIENT_CLOSED_REQUEST
+            raise
+        finally:
+            dbtb.performance.record(route, time.perf_counter() - started, status)
+
+    async def capture_request(request):
+        """Capture the request if it's needed."""
 
         # Check for debugtoolbar is enabled for the request
-        if not dbtb.cfg.enabled or any(map(request.path.startswith, dbtb.cfg.exclude)):
-            return (yield from handler(request))
+        if not dbtb.filter(request):
+            return await handler(request)
 
-        remote_host, remote_port = request.transport.get_extra_info('peername')
-        for host in dbtb.cfg.hosts:
-            if ip.ip_address(remote_host) in ip.ip_network(host):
-                break
-        else:
-            return (yield from handler(request))
+        # Sample the requests (a developer could force capturing with the header)
+        if dbtb.cfg.force_header not in request.headers:
+            if not dbtb.capture():
+                return await handler(request)
+
+            # The sample isn't used up by a request throttled by the budget
+            if not dbtb.budget.allow():
+                dbtb.capture.refund()
+                return await handler(request)
 
         # Initialize a debugstate for the request
-        state = DebugState(app, request)
-        dbtb.history[state.id] = state
+        with dbtb.budget.measure():
+            state = DebugState(app, request)
         context_switcher = state.wrap_handler(handler)
+        token = utils.CURRENT_STATE.set(state)
+
+        try:
+            return await process_request(state, context_switcher(handler(request)))
+        except asyncio.CancelledError:
+            state.status = CLIENT_CLOSED_REQUEST
+            raise
+        finally:
+            state.cleanup()
+            utils.CURRENT_STATE.reset(token)
+            with dbtb.budget.measure():
+                dbtb.store(state)
+
+    async def process_request(state, coro):
+        """Run the request's handler and process the response."""
+        request = state.request
 
         # Make response
         try:
-            response = yield from context_switcher(handler(request))
+            response = await coro
             state.status = response.status
         except HTTPException as exc:
             response = exc
@@ -62,27 +110,37 @@ def debugtoolbar_middleware_factory(app, handler):
             state.status = 500
             if not dbtb.cfg.intercept_exc:
                 raise
-            tb = get_traceback(
-                info=sys.exc_info(), skip=1, show_hidden_frames=False,
-                ignore_system_exceptions=True, exc=exc)
-            dbtb.exceptions[tb.id] = request['pdbt_tb'] = tb
-            for frame in tb.frames:
-                dbtb.frames[id(frame)] = frame
-            response = Response(text=tb.render_full(request), content_type='text/html')
+            with dbtb.budget.measure():
+                tb = get_traceback(
+                    info=sys.exc_info(), skip=1, show_hidden_frames=False,
+                    ignore_system_exceptions=True, exc=exc)
+                dbtb.exceptions[tb.id] = request['pdbt_tb'] = tb
+                for frame in tb.frames:
+                    dbtb.frames[id(frame)] = frame
+                response = Response(text=tb.render_full(request), content_type='text/html')
 
         # Intercept http redirect codes and display an html page with a link to the target.
         if dbtb.cfg.intercept_redirects and response.status in REDIRECT_CODES \
                 and 'Location' in response.headers:
 
-            response = yield from app.ps.jinja2.render(
+            response = await app.ps.jinja2.render(
                 'debugtoolbar/redirect.html', response=response)
             response = Response(text=response, content_type='text/html')
 
-        yield from state.process_response(response)
+        # The panels could await (e.g. a request's body), only their steps are measured
+        await dbtb.budget.measure_await(state.process_response(response))
 
-        if isinstance(response, Response) and response.content_type == 'text/html' and \
-                RE_BODY.search(response.body):
-            return (yield from dbtb.inject(state, response))
+        # Inject the toolbar only when the state is kept (the toolbar links to it)
+        with dbtb.budget.measure():
+            if isinstance(response, Response) and response.content_type == 'text/html' and \
+                    response.body and dbtb.retain(state):
+                encoding = response.headers.get('Content-Encoding', 'identity')
+                if encoding.strip().lower() != 'identity':
+                    return dbtb.inject_compressed(state, response, encoding)
+
+                position = utils.find_body_end(response.body)
+                if position >= 0:
+                    return dbtb.inject(state, response, position)
 
         return response
 
@@ -101,11 +159,74 @@ class Plugin(BasePlugin):
         'intercept_exc': 'debug',  # debug/display/False,
         'intercept_redirects': True,
         'exclude': [],
+
+        # Capture only the matching requests
+        'filter': {
+            'path': None,       # A regular expression for the request's path
+            'methods': None,    # A list of HTTP methods
+            'headers': None,    # A mapping of header names to regular expressions
+            'flag': None,       # A name of a cookie or a query param to opt-in
+        },
+
+        # Capture every Nth request (> 1) or with a probability (< 1)
+        'sample_rate': 1,
+        # Limit captured requests per second (0 to disable)
+        'max_captures_per_second': 0,
+        # Capture requests with the header regardless of sampling
+        'force_header': 'X-Debug-Toolbar',
+
+        # Throttle capturing when the toolbar's work takes more than the fraction of time
+        'budget_overhead': 0.1,
+        # ... or when the event loop's lag is greater (in seconds, 0 to disable)
+        'budget_lag': 0.1,
+
+        # Keep in the history only the requests slower than the threshold (in seconds) and
+        # the failed ones (4xx/5xx, unhandled exceptions), only count others (None to keep all)
+        'retention_threshold': None,
+        # Retention thresholds per route name ({'route_name': seconds})
+        'retention_routes': {},
+
+        # Where to store the requests history: memory, sqlite:///path/to/history.db
+        'history_backend': 'memory',
+        # A memory budget of the requests history (in bytes)
+        'history_size': 32 * 1024 * 1024,
+
+        # Database adapters to track the queries (classes or 'module:Class' strings)
+        'sql_adapters': [sql.SQLiteAdapter],
+
+        # Sliding windows of the route performance stats (in seconds, empty to disable)
+        'performance_windows': [60, 300, 900],
+        # The windows' precision (in seconds)
+        'performance_slot': 15,
+
+        # Report the event loop's blocks longer than the threshold (in seconds, 0 to disable)
+        'watchdog_threshold': 0.1,
+
+        # How many rendered panels to cache
+        'rendered_panels_cache_size': 32,
+
+        # Check the shared history for new requests (in seconds)
+        'sse_poll_interval': 2,
+
+        'profiler_interval': 0.005,
+
+        # The memory panel: frames to trace per allocation (0 to count allocated blocks only)
+        # and how many top allocation sites to show
+        'memory_trace_frames': 1,
+        'memory_top': 10,
+
         'panels': [
             panels.HeaderDebugPanel,
             panels.RequestVarsDebugPanel,
             panels.LoggingDebugPanel,
             panels.TracebackDebugPanel,
+            panels.TimingDebugPanel,
+            panels.SQLDebugPanel,
+            panels.TemplatesDebugPanel,
+            panels.MiddlewareTimingDebugPanel,
+            panels.LoopBlocksDebugPanel,
+            panels.TasksDebugPanel,
+            panels.GCDebugPanel,
         ],
         'additional_panels': [],
         'global_panels': [
@@ -113,6 +234,12 @@ class Plugin(BasePlugin):
             panels.ConfigurationDebugPanel,
             panels.MiddlewaresDebugPanel,
             panels.VersionsDebugPanel,
+            panels.BudgetDebugPanel,
+            panels.CountersDebugPanel,
+            panels.RoutePerformanceDebugPanel,
+            panels.LoopWatchdogDebugPanel,
+            panels.PendingTasksDebugPanel,
+            panels.GCPausesDebugPanel,
         ]
     }
 
@@ -156,54 +283,255 @@ class Plugin(BasePlugin):
             self.cfg.prefix.rstrip('/'),
             self.cfg.prefix,
             self.cfg.prefix + '{request_id}', name='debugtoolbar.request')(self.view)
+        app.register(
+            self.cfg.prefix + '{request_id}/panel/{dom_id}', name='debugtoolbar.panel')(self.panel)
+        app.register(
+            self.cfg.prefix + '{request_id}/explain/{index}',
+            name='debugtoolbar.explain')(self.explain)
 
         app['debugtoolbar'] = {}
         app['debugtoolbar']['pdbt_token'] = uuid.uuid4().hex
-        self.history = app['debugtoolbar']['history'] = utils.History(50)
+        self.history = app['debugtoolbar']['history'] = create_history(
+            self.cfg.history_backend, self.cfg.history_size, app)
         self.exceptions = app['debugtoolbar']['exceptions'] = utils.History(50)
         self.frames = app['debugtoolbar']['frames'] = utils.History(100)
-
-    @asyncio.coroutine
-    def start(self, app):
+        self.rendered_panels = utils.LRUCache(self.cfg.rendered_panels_cache_size)
+        self.sampler = utils.StackSampler(self.cfg.profiler_interval)
+        self.memory = utils.MemoryTracer(self.cfg.memory_trace_frames)
+        self.filter = utils.RequestFilter(
+            hosts=self.cfg.hosts, exclude=self.cfg.exclude, **self.cfg.filter)
+        self.capture = utils.CaptureSampler(
+            self.cfg.sample_rate, self.cfg.max_captures_per_second)
+        self.budget = utils.CaptureBudget(self.cfg.budget_overhead, self.cfg.budget_lag)
+        self.retention = utils.RetentionPolicy(
+            self.cfg.retention_threshold, self.cfg.retention_routes)
+        self.counters = utils.RouteCounters()
+        self.performance = self.cfg.performance_windows and utils.RoutePerformance(
+            self.cfg.performance_windows, self.cfg.performance_slot) or None
+        self.broker = utils.Broker()
+        self.tasks = utils.TaskTracker()
+        self.gc = utils.GCTracker()
+        self.http_client = client.ClientTracer()
+        self.templates = utils.TemplateTracker()
+        self.watchdog = self.cfg.watchdog_threshold and utils.LoopWatchdog(
+            self.cfg.watchdog_threshold) or None
+        self.heartbeat = utils.Heartbeat(
+            min(self.watchdog.interval, 0.1) if self.watchdog is not None else 0.1)
+
+        self.logging = utils.LogRecordTracker()
+        self.sql_adapters = {}
+        self.middleware_stats = OrderedDict()
+
+        # Inject the toolbar to streamed responses
+        app.on_response_prepare.append(self.on_response_prepare)
+        app.on_shutdown.append(self.on_shutdown)
+
+    async def start(self, app):
         """ Start application. """
+        # Measure time spent in the application's middlewares
+        if self.cfg.enabled and self.has_panel(panels.MiddlewareTimingDebugPanel):
+            for idx, factory in enumerate(app.middlewares):
+                stats = self.middleware_stats[repr(factory)] = utils.RollingStats()
+                app.middlewares[idx] = utils.TimedMiddlewareFactory(factory, stats)
+
         app.middlewares.insert(0, debugtoolbar_middleware_factory)
-        self.global_panels = [Panel(self.app) for Panel in self.cfg.global_panels]
 
-    @asyncio.coroutine
-    def inject(self, state, response):
-        """ Inject Debug Toolbar code to response body. """
-        html = yield from self.app.ps.jinja2.render(
+        # Route log records to the captured requests
+        if self.cfg.enabled and self.has_panel(panels.LoggingDebugPanel):
+            self.logging.install()
+
+        # Hook the database drivers
+        if self.cfg.enabled and self.has_panel(panels.SQLDebugPanel):
+            for adapter in self.cfg.sql_adapters:
+                if isinstance(adapter, str):
+                    mod, _, adapter = adapter.partition(':')
+                    adapter = getattr(importlib.import_module(mod), adapter)
+                adapter = self.sql_adapters[adapter.name] = adapter()
+                adapter.install()
+
+        # Trace the outgoing HTTP requests
+        if self.cfg.enabled and self.has_panel(panels.HTTPClientDebugPanel):
+            self.http_client.install()
+
+        # Time the application's templates
+        if self.cfg.enabled and self.has_panel(panels.TemplatesDebugPanel):
+            self.templates.install(app.ps.jinja2)
+
+        # Precompile Debug Toolbar code with a slot for request id
+        self.snippet = utils.Snippet(await app.ps.jinja2.render(
             'debugtoolbar/inject.html',
             static_path=self.cfg.prefix + 'static',
-            toolbar_url=self.cfg.prefix + state.id,
-        )
-        html = html.encode(state.request.charset or 'utf-8')
-        response.body = RE_BODY.sub(html + b'</body>', response.body)
+            toolbar_url=self.cfg.prefix + utils.Snippet.SLOT,
+        ))
+
+        # Monitor the event loop with a single heartbeat
+        if self.cfg.enabled:
+            if self.budget.max_lag:
+                self.heartbeat.add(self.budget.heartbeat)
+            if self.watchdog is not None:
+                self.watchdog.start(self.heartbeat)
+            self.heartbeat.start(app.loop)
+
+        self.global_panels = [Panel(self.app) for Panel in self.cfg.global_panels]
+
+    def has_panel(self, panel_cls):
+        """Check the panel (or its subclass) is enabled."""
+        return any(issubclass(panel, panel_cls) for panel in self.cfg.panels)
+
+    async def on_shutdown(self, app):
+        """ Restore the hooked libraries and store the queued requests. """
+        self.logging.uninstall()
+        for adapter in self.sql_adapters.values():
+            adapter.uninstall()
+        self.http_client.uninstall()
+        self.templates.uninstall()
+        self.heartbeat.stop()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        close = getattr(self.history, 'close', None)
+        if close is not None:
+            close()
+
+    def retain(self, state):
+        """Decide whether the state will be kept in the history (before injecting the toolbar,
+        which links to the state)."""
+        if state.retained is None:
+            state.retained = state.failed or self.retention(state.route, state.duration)
+        return state.retained
+
+    def store(self, state):
+        """Store the state in the history or only count it.
+
+        The panels are rendered here, a failed panel doesn't break the application's response
+        (the request is only counted then).
+        """
+        if self.retain(state):
+            try:
+                snapshot = state.freeze()
+            except Exception:
+                logger.exception('Failed to freeze the request %s', state.id)
+            else:
+                self.history[state.id] = snapshot
+                self.broker.publish((state.id, snapshot.json))
+                return
+
+        self.counters.add(state.route, state.duration)
+
+    def render_snippet(self, state, charset=None):
+        """ Render Debug Toolbar code for the request (from the precompiled snippet). """
+        return self.snippet.render(state.id, charset or 'utf-8')
+
+    def inject(self, state, response, position):
+        """ Inject Debug Toolbar code to response body at the given position. """
+        html = self.render_snippet(state, response.charset)
+        body = memoryview(response.body)
+        response.body = b''.join((body[:position], html, body[position:]))
         return response
 
-    @asyncio.coroutine
-    def view(self, request):
+    def inject_compressed(self, state, response, encoding):
+        """ Inject Debug Toolbar code to a compressed response body. """
+        html = self.render_snippet(state, response.charset)
+        body = utils.inject_compressed(response.body, encoding, html)
+        if body is not None:
+            response.body = body
+        return response
+
+    async def on_response_prepare(self, request, response):
+        """ Inject Debug Toolbar code to a streamed HTML response of a captured request.
+
+        Plain responses are injected by the middleware. Streamed ones are prepared (and
+        written) by the handler while the request's state is active.
+        """
+        state = utils.CURRENT_STATE.get()
+        if state is None or state.request is not request or isinstance(response, Response) \
+                or response.content_type != 'text/html':
+            return
+
+        # The stream is prepared before the request's duration is known, so the state is kept
+        state.retained = True
+        with self.budget.measure():
+            injector = utils.StreamInjector(self.render_snippet(state, response.charset))
+
+        # Whether the snippet is written is known only at the end of the body
+        response.content_length = None
+
+        write, write_eof = response.write, response.write_eof
+
+        def inject_write(data):
+            data = injector.feed(data)
+            return write(data) if data else ()
+
+        async def inject_write_eof():
+            if not response._eof_sent:
+                write(injector.flush())
+            return await write_eof()
+
+        response.write, response.write_eof = inject_write, inject_write_eof
+
+    async def view(self, request):
         """ Debug Toolbar. """
-        auth = yield from self.authorize(request)
+        auth = await self.authorize(request)
         if not auth:
             raise HTTPForbidden()
 
         request_id = request.match_info.get('request_id')
         state = self.history.get(request_id, None)
 
-        response = yield from self.app.ps.jinja2.render(
+        response = await self.app.ps.jinja2.render(
             'debugtoolbar/toolbar.html',
             debugtoolbar=self,
             state=state,
             static_path=self.cfg.prefix + 'static',
             panels=state and state.panels or [],
             global_panels=self.global_panels,
-            request=state and state.request or None,
         )
         return Response(text=response, content_type='text/html')
 
-    @asyncio.coroutine
-    def authorize(self, request):  # noqa
+    async def panel(self, request):
+        """ Render a panel of the captured request (panels are loaded lazily by the toolbar). """
+        auth = await self.authorize(request)
+        if not auth:
+            raise HTTPForbidden()
+
+        key = request.match_info['request_id'], request.match_info['dom_id']
+        content = self.rendered_panels.get(key)
+        if content is None:
+            state = self.history.get(key[0], None)
+            panel = state and next((p for p in state.panels if p.dom_id == key[1]), None)
+            if panel is None:
+                raise HTTPNotFound()
+
+            # Snapshots are immutable, so the content could be cached
+            content = self.rendered_panels[key] = panel.render_content()
+
+        return Response(text=content, content_type='text/html')
+
+    async def explain(self, request):
+        """ Explain a query of the captured request. """
+        auth = await self.authorize(request)
+        if not auth:
+            raise HTTPForbidden()
+
+        state = self.history.get(request.match_info['request_id'], None)
+        panel = state and next(
+            (p for p in state.panels if p.name == panels.SQLDebugPanel.name), None)
+        try:
+            query = panel.context['queries'][int(request.match_info['index'])]
+            adapter = self.sql_adapters[query['adapter']]
+        except (AttributeError, LookupError, ValueError):
+            raise HTTPNotFound()
+
+        columns = rows = error = None
+        try:
+            columns, rows = adapter.explain(query['database'], query['sql'], query['params'])
+        except Exception as exc:
+            error = exc
+
+        text = await self.app.ps.jinja2.render(
+            'debugtoolbar/panels/sql_explain.html', columns=columns, rows=rows, error=error)
+        return Response(text=text, content_type='text/html')
+
+    async def authorize(self, request):  # noqa
         """Default authorization."""
         return True
 
@@ -223,26 +551,53 @@ class Plugin(BasePlugin):
         self.authorize = to_coroutine(func)
         return func
 
-    @asyncio.coroutine
-    def sse(self, request):
-        """SSE."""
-        response = Response(status=200)
-        response.content_type = 'text/event-stream'
-        response.text = ''
-        active_request_id = request.GET.get('request_id')
-        client_last_request_id = str(request.headers.get('Last-Event-Id', 0))
-        if self.history:
-            last_request_id = next(reversed(self.history))
-            if not last_request_id == client_last_request_id:
-                data = []
-                for _id in reversed(self.history):
-                    data.append([
-                        _id, self.history[_id].json, 'active' if active_request_id == _id else ''])
-                if data:
-                    response.text = U_SSE_PAYLOAD.format(last_request_id, json.dumps(data))
+    async def sse(self, request):
+        """Stream the captured requests (Server-Sent Events).
+
+        The stream is resumed from the Last-Event-Id. The new requests are pushed as they are
+        captured (and are polled from the history which could be shared between processes).
+        """
+        subscription = self.broker.subscribe()
+        try:
+            response = StreamResponse()
+            response.content_type = 'text/event-stream'
+            response.headers['Cache-Control'] = 'no-cache'
+            await response.prepare(request)
+
+            last_id = request.headers.get('Last-Event-Id')
+            while True:
+                # Replay the missed requests or poll the shared history
+                for _id in self.history_since(last_id):
+                    snapshot = self.history.get(_id)
+                    if snapshot is not None:
+                        last_id = self.send_event(response, _id, snapshot.json)
+
+                messages = await subscription.get(self.cfg.sse_poll_interval)
+                for _id, data in messages:
+                    last_id = self.send_event(response, _id, data)
+                if not messages:
+                    response.write(b': ping\n\n')
+                await response.drain()
+        finally:
+            self.broker.unsubscribe(subscription)
 
         return response
 
+    @staticmethod
+    def send_event(response, request_id, data):
+        """Send an event to the SSE stream."""
+        response.write(U_SSE_PAYLOAD.format(request_id, json.dumps(data)).encode('utf-8'))
+        return request_id
+
+    def history_since(self, last_id, limit=50):
+        """Get ids of the requests captured after the given one (from the oldest)."""
+        ids = []
+        for _id in reversed(self.history):
+            if _id == last_id or len(ids) >= limit:
+                break
+            ids.append(_id)
+        return reversed(ids)
+
     def validate_pdtb_token(self, request):
         token = request.GET.get('token')
 
@@ -261,8 +616,7 @@ class Plugin(BasePlugin):
             return HTTPBadRequest()
         return self.frames[frame]
 
-    @asyncio.coroutine
-    def exception(self, request):
+    async def exception(self, request):
         self.validate_pdtb_token(request)
         tb = int(request.GET.get('tb', 0))
         if not tb or tb not in self.exceptions:
@@ -270,8 +624,7 @@ class Plugin(BasePlugin):
         tb = self.exceptions[tb]
         return Response(text=tb.render_full(request), content_type='text/html')
 
-    @asyncio.coroutine
-    def execute(self, request):
+    async def execute(self, request):
         self.validate_pdtb_token(request)
         if not self.cfg.intercept_exc == 'debug':
             raise HTTPBadRequest()
@@ -282,8 +635,7 @@ class Plugin(BasePlugin):
         result = frame.console.eval(cmd)
         return Response(text=result, content_type='text/html')
 
-    @asyncio.coroutine
-    def source(self, request):
+    async def source(self, request):
         self.validate_pdtb_token(request)
         frame = self.get_frame(request)
         return Response(text=frame.render_source(), content_type='text/html')
@@ -295,15 +647,15 @@ class DebugState:
 
     def __init__(self, app, request):
         """Store the params."""
+        self.id = uuid.uuid4().hex
         self.request = request
         self.status = 200
+        self.route = utils.route_name(request)
+        self.started = time.perf_counter()
+        self.finished = None
+        self.retained = None
         self.panels = [Panel(app, request) for Panel in app.ps.debugtoolbar.cfg.panels]
 
-    @property
-    def id(self):
-        """Return state ID."""
-        return str(id(self))
-
     @property
     def json(self):
         """Return JSON."""
@@ -312,14 +664,35 @@ class DebugState:
                 'scheme': 'http',
                 'status_code': self.status}
 
+    @property
+    def duration(self):
+        """Return the request's duration (in seconds)."""
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def failed(self):
+        """The request is failed (an error status or an unhandled exception)."""
+        return self.status >= 400 or 'pdbt_tb' in self.request
+
     def wrap_handler(self, handler):
         context_switcher = utils.ContextSwitcher()
         for panel in self.panels:
             panel.wrap_handler(handler, context_switcher)
         return context_switcher
 
-    @asyncio.coroutine
-    def process_response(self, response):
+    async def process_response(self, response):
         """Process response."""
+        self.finished = time.perf_counter()
+        for panel in self.panels:
+            await panel.process_response(response)
+
+    def cleanup(self):
+        """Release the panels' resources (the response could be not processed)."""
         for panel in self.panels:
-            yield from panel.process_response(response)
+            panel.cleanup()
+
+    def freeze(self):
+        """Freeze the state into a compact snapshot without links to the request."""
+        return StateSnapshot(
+            self.id, self.request.method, self.request.path, 'http', self.status, self.route,
+            self.duration, [panel.freeze() for panel in self.panels])
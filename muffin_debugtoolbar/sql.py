@@ -0,0 +1,266 @@
+"""Database queries tracking.
+
+The queries are recorded by adapters only for the captured requests (see `QUERIES`). An
+adapter hooks a database driver when the application starts:
+
+* `SQLiteAdapter` -- the standard `sqlite3` module (the reference adapter);
+* a custom adapter patches a driver's (sync or coroutine) methods: ::
+
+    class AiopgAdapter(QueryAdapter):
+
+        name = 'aiopg'
+
+        def install(self):
+            import aiopg
+            self.patch(aiopg.Cursor, 'execute')
+
+The adapters are enabled with the `sql_adapters` option.
+
+"""
+import asyncio
+import functools
+import os.path as op
+import re
+import sqlite3
+import sys
+import time
+import traceback
+from urllib.parse import quote
+
+from .utils import QUERIES
+
+
+class Query:
+
+    """A recorded query."""
+
+    __slots__ = 'adapter', 'database', 'sql', 'params', 'duration', 'site', 'stack'
+
+    def __init__(self, adapter, database, sql, params, duration, site, stack):
+        self.adapter = adapter
+        self.database = database
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.site = site
+        self.stack = stack
+
+
+class QueryAdapter:
+
+    """The adapters' interface."""
+
+    name = None
+    stack_limit = 10
+
+    def __init__(self):
+        self._patched = []
+
+    def install(self):
+        """Hook the driver."""
+        raise NotImplementedError
+
+    def uninstall(self):
+        """Restore the patched methods."""
+        while self._patched:
+            owner, name, method = self._patched.pop()
+            setattr(owner, name, method)
+
+    def explain(self, database, sql, params):
+        """Explain the query, return the columns and the rows."""
+        raise NotImplementedError
+
+    def database(self, obj):
+        """Get the database of the patched method's owner (see `explain`)."""
+        return None
+
+    def patch(self, owner, *names):
+        """Replace the owner's methods `method(obj, sql, params...)` with tracked ones."""
+        for name in names:
+            method = getattr(owner, name)
+            self._patched.append((owner, name, method))
+            setattr(owner, name, self.wrap(method))
+
+    def wrap(self, method):
+        """Record the calls of the method (a function or a coroutine function)."""
+        adapter = self
+
+        if asyncio.iscoroutinefunction(method):
+
+            @functools.wraps(method)
+            async def tracked(obj, sql, *params, **kwargs):
+                queries = QUERIES.get()
+                if queries is None:
+                    return await method(obj, sql, *params, **kwargs)
+
+                started = time.perf_counter()
+                try:
+                    return await method(obj, sql, *params, **kwargs)
+                finally:
+                    adapter.record(
+                        queries, adapter.database(obj), sql, params, started)
+
+            return tracked
+
+        @functools.wraps(method)
+        def tracked(obj, sql, *params, **kwargs):
+            queries = QUERIES.get()
+            if queries is None:
+                return method(obj, sql, *params, **kwargs)
+
+            started = time.perf_counter()
+            try:
+                return method(obj, sql, *params, **kwargs)
+            finally:
+                adapter.record(queries, adapter.database(obj), sql, params, started)
+
+        return tracked
+
+    def record(self, queries, database, sql, params, started):
+        """Record the query with its call site."""
+        duration = time.perf_counter() - started
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename == __file__:
+            frame = frame.f_back
+
+        site = stack = None
+        if frame is not None:
+            code = frame.f_code
+            site = '%s (%s:%d)' % (code.co_name, op.basename(code.co_filename), frame.f_lineno)
+            stack = ''.join(traceback.format_stack(frame, limit=self.stack_limit))
+        del frame
+
+        if len(params) == 1:
+            params = params[0]
+        if isinstance(params, tuple):
+            params = list(params)
+        queries.append(Query(self.name, database, sql, params, duration, site, stack))
+
+
+class TrackedSQLiteCursor(sqlite3.Cursor):
+
+    """A cursor which records the queries."""
+
+    def execute(self, sql, parameters=()):
+        queries = QUERIES.get()
+        if queries is None:
+            return super(TrackedSQLiteCursor, self).execute(sql, parameters)
+
+        started = time.perf_counter()
+        try:
+            return super(TrackedSQLiteCursor, self).execute(sql, parameters)
+        finally:
+            self.connection.adapter.record(
+                queries, self.connection.database, sql, (parameters,), started)
+
+    def executemany(self, sql, seq_of_parameters):
+        queries = QUERIES.get()
+        if queries is None:
+            return super(TrackedSQLiteCursor, self).executemany(sql, seq_of_parameters)
+
+        started = time.perf_counter()
+        try:
+            return super(TrackedSQLiteCursor, self).executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.adapter.record(
+                queries, self.connection.database, sql, ('<many>',), started)
+
+
+class TrackedSQLiteConnection(sqlite3.Connection):
+
+    """A connection which creates the tracked cursors."""
+
+    adapter = None
+
+    def __init__(self, database, *args, **kwargs):
+        super(TrackedSQLiteConnection, self).__init__(database, *args, **kwargs)
+        self.database = database
+
+    def cursor(self, factory=TrackedSQLiteCursor):
+        return super(TrackedSQLiteConnection, self).cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class SQLiteAdapter(QueryAdapter):
+
+    """Track the queries of the `sqlite3` connections opened with `sqlite3.connect`.
+
+    The connections opened before the application starts aren't tracked.
+
+    """
+
+    name = 'sqlite3'
+
+    def install(self):
+        """Replace `sqlite3.connect` to open the tracked connections."""
+        TrackedSQLiteConnection.adapter = self
+        self._patched.append((sqlite3, 'connect', sqlite3.connect))
+        connect = sqlite3.connect
+
+        @functools.wraps(connect)
+        def tracked_connect(database, *args, **kwargs):
+            if len(args) < 5:
+                kwargs.setdefault('factory', TrackedSQLiteConnection)
+            return connect(database, *args, **kwargs)
+
+        sqlite3.connect = tracked_connect
+
+    def explain(self, database, sql, params):
+        """Get the query plan (the query isn't executed)."""
+        if not database or database == ':memory:' or str(database).startswith('file:'):
+            raise ValueError('The database could not be reopened: %s' % database)
+
+        conn = sqlite3.Connection('file:%s?mode=ro' % quote(str(database)), uri=True)
+        try:
+            if params == '<many>':
+                params = ()
+            cursor = conn.execute('EXPLAIN QUERY PLAN ' + sql, params or ())
+            return [column[0] for column in cursor.description], cursor.fetchall()
+        finally:
+            conn.close()
+
+
+RE_PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+")
+RE_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+RE_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+RE_SPACES = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """Replace the query's parameters and literals with placeholders."""
+    sql = RE_PLACEHOLDERS.sub('?', sql)
+    sql = RE_LITERALS.sub('?', sql)
+    sql = RE_LISTS.sub('(?)', sql)
+    return RE_SPACES.sub(' ', sql).strip()
+
+
+def repeated(queries):
+    """Find the queries which are repeated (duplicates) or differ only by params (N+1).
+
+    :return: A list of dicts: sql, count, distinct params, kind, duration
+    """
+    groups = {}
+    for query in queries:
+        group = groups.get(normalize(query.sql))
+        if group is None:
+            group = groups[normalize(query.sql)] = []
+        group.append(query)
+
+    result = []
+    for sql, group in groups.items():
+        if len(group) < 2:
+            continue
+        distinct = len({(query.sql, repr(query.params)) for query in group})
+        result.append({
+            'sql': sql,
+            'count': len(group),
+            'distinct': distinct,
+            'kind': distinct == 1 and 'duplicate' or 'N+1',
+            'duration': sum(query.duration for query in group),
+        })
+    return sorted(result, key=lambda group: group['count'], reverse=True)
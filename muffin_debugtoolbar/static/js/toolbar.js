@@ -13,6 +13,16 @@ function toggle_active(elem) {
     elem.toggleClass('active');
 }
 
+// Load the panel's content once it's shown
+function load_panel(elem) {
+    var scroll = elem.find('[data-panel-url]');
+    if (scroll.length && !scroll.data('loaded')) {
+        scroll.data('loaded', true);
+        scroll.html('Loading...');
+        scroll.load(scroll.data('panel-url'));
+    }
+}
+
 jQuery(document).ready(function($) {
 
 
@@ -27,6 +37,20 @@ $(".pDebugPanels li:not(.disabled) a").click( function(event_) {
     $(".pDebugWindow").show();
     current = $('.pDebugWindow #' + parent_.attr('id') + '-content');
     current.show();
+    load_panel(current);
+});
+
+
+// Explain a database query (the panels are loaded lazily)
+$(document).on('click', '.pDebugExplain', function(event_) {
+    event_.preventDefault();
+    var target = $($(this).data('target'));
+    if (target.is(':empty')) {
+        target.html('Loading...');
+        target.load($(this).data('explain-url'));
+    } else {
+        toggle_content(target);
+    }
 });
 
 
@@ -64,7 +88,7 @@ $('#settings .switch').click(function() {
 bootstrap_panels = ['pDebugVersionsPanel', 'pDebugHTTPHeadersPanel']
 
 for (var i = 0; i < bootstrap_panels.length; i++) {
-    $('.pDebugWindow #' + bootstrap_panels[i] + '-content').show();
+    load_panel($('.pDebugWindow #' + bootstrap_panels[i] + '-content').show());
     $('li#' + bootstrap_panels[i]).addClass('active');
 }
 
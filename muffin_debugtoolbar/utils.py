@@ -1,8 +1,25 @@
 """ Debugtoolbar utils. """
 
+import asyncio
+import gc
+import heapq
+import ipaddress as ip
 import logging
+import math
+import os.path as op
+import random
+import re
 import sys
-from collections import OrderedDict, deque
+import threading
+import time
+import traceback
+import tracemalloc
+import weakref
+import zlib
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from contextvars import ContextVar
+from functools import lru_cache
 
 
 class History(OrderedDict):
@@ -21,22 +38,979 @@ class History(OrderedDict):
             self.popitem(False)
 
 
-class LoggingTrackingHandler(logging.Handler):
+#: The active request's debug state
+CURRENT_STATE = ContextVar('debugtoolbar_state', default=None)
 
-    def __init__(self, *args, **kwargs):
-        super(LoggingTrackingHandler, self).__init__(*args, **kwargs)
-        self.records = deque(maxlen=100)
+#: The active request's log records buffer
+LOG_RECORDS = ContextVar('debugtoolbar_log_records', default=None)
 
-    def emit(self, record):
-        self.records.append(record)
+#: The active request's middlewares timings ({name: [total, inner]})
+MIDDLEWARE_TIMINGS = ContextVar('debugtoolbar_middleware_timings', default=None)
+
+#: The active request's tasks records
+TASKS = ContextVar('debugtoolbar_tasks', default=None)
+
+#: The active request's garbage collections
+GC_COLLECTIONS = ContextVar('debugtoolbar_gc_collections', default=None)
+
+#: The active request's database queries
+QUERIES = ContextVar('debugtoolbar_queries', default=None)
+
+#: The active request's outgoing HTTP requests
+HTTP_CALLS = ContextVar('debugtoolbar_http_calls', default=None)
+
+#: The active request's rendered templates
+TEMPLATES = ContextVar('debugtoolbar_templates', default=None)
+
+#: A compact snapshot of a log record
+LogEntry = namedtuple('LogEntry', 'message created level pathname lineno')
+
+
+class RequestFilter:
+
+    """Decide whether a request should be captured by the toolbar.
+
+    The rules are compiled once, the checks are ordered from the cheapest one and a
+    request is rejected with the first failed check.
+
+    :param hosts: A list of allowed networks (`127.0.0.1`, `10.0.0.0/8`)
+    :param exclude: A list of excluded path prefixes
+    :param path: A regular expression which the request's path should match
+    :param methods: A list of allowed HTTP methods
+    :param headers: A mapping of header names to regular expressions
+    :param flag: A name of a cookie or a query param which enables capturing
+
+    """
+
+    def __init__(self, hosts=('127.0.0.1',), exclude=(), path=None, methods=None,
+                 headers=None, flag=None):
+        """Compile the rules."""
+        self.networks = [ip.ip_network(host) for host in hosts]
+        self.checks = []
+
+        if exclude:
+            exclude = tuple(exclude)
+            self.checks.append(lambda request: not request.path.startswith(exclude))
+
+        if methods:
+            methods = frozenset(method.upper() for method in methods)
+            self.checks.append(lambda request: request.method in methods)
+
+        if path:
+            match = re.compile(path).match
+            self.checks.append(lambda request: match(request.path) is not None)
+
+        if flag:
+            self.checks.append(lambda request: flag in request.cookies or flag in request.GET)
+
+        for name, value in (headers or {}).items():
+            self.checks.append(self.compile_header(name, value))
+
+        self.allowed_host = lru_cache(maxsize=1024)(self.allowed_host)
+        self.checks.append(self.check_host)
+
+    @staticmethod
+    def compile_header(name, value):
+        """Compile a header's rule."""
+        match = re.compile(value).match
+        return lambda request: match(request.headers.get(name, '')) is not None
+
+    def allowed_host(self, host):
+        """Check the remote host is in the allowed networks (the results are cached)."""
+        address = ip.ip_address(host)
+        return any(address in network for network in self.networks)
+
+    def check_host(self, request):
+        """Check the request's remote host."""
+        peername = request.transport.get_extra_info('peername')
+        return bool(peername) and self.allowed_host(peername[0])
+
+    def __call__(self, request):
+        """Check the request."""
+        for check in self.checks:
+            if not check(request):
+                return False
+        return True
+
+
+def sizeof(obj, seen=None):
+    """Estimate a size of the plain data (strings, numbers, containers) in bytes.
+
+    A container is counted once, even when it's shared or it references itself.
+    """
+    if isinstance(obj, (dict, list, tuple, set, frozenset, deque)):
+        if seen is None:
+            seen = set()
+        elif id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        if isinstance(obj, dict):
+            return sys.getsizeof(obj) + sum(
+                sizeof(key, seen) + sizeof(value, seen) for key, value in obj.items())
+        return sys.getsizeof(obj) + sum(sizeof(item, seen) for item in obj)
+
+    return sys.getsizeof(obj)
+
+
+def route_name(request):
+    """Get a name of the request's route."""
+    route = getattr(request.match_info, 'route', None)
+    return getattr(route, 'name', None) or '<unnamed>'
+
+
+class CaptureSampler:
+
+    """Sample the requests to capture and limit the captures rate.
+
+    :param rate: Capture every Nth request when the rate is greater than 1 or
+        capture a request with the probability when the rate is less than 1.
+    :param max_per_second: Limit captures per second with a token bucket (0 to disable)
+
+    """
+
+    def __init__(self, rate=1, max_per_second=0):
+        """Prepare the sampler."""
+        if rate <= 0:
+            raise ValueError('Sample rate should be positive.')
+        self.rate = rate
+        self.max_per_second = max_per_second
+        self.counter = 0
+        self.tokens = max_per_second
+        self.updated = time.monotonic()
+
+    def sample(self):
+        """Check the request is sampled."""
+        if self.rate == 1:
+            return True
+
+        if self.rate > 1:
+            self.counter += 1
+            if self.counter < self.rate:
+                return False
+            self.counter = 0
+            return True
+
+        return random.random() < self.rate
+
+    def acquire(self):
+        """Take a token from the bucket."""
+        if not self.max_per_second:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(
+            self.max_per_second, self.tokens + (now - self.updated) * self.max_per_second)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def __call__(self):
+        """Check the request should be captured."""
+        return self.sample() and self.acquire()
+
+    def refund(self):
+        """Give back the sample and the token of a request which hasn't been captured."""
+        if self.rate > 1:
+            self.counter = self.rate - 1
+        if self.max_per_second:
+            self.tokens = min(self.max_per_second, self.tokens + 1)
+
+
+class Heartbeat:
+
+    """A periodic callback of the event loop shared by the loop's monitors.
+
+    The listeners are called with the lag of the scheduled callback every `interval` seconds.
+
+    """
+
+    def __init__(self, interval=0.1):
+        """Initialize the heartbeat."""
+        self.interval = interval
+        self.listeners = []
+        self.loop = self.handle = None
+
+    def add(self, listener):
+        """Call the listener every beat."""
+        self.listeners.append(listener)
+
+    def start(self, loop):
+        """Start beating (when there are listeners)."""
+        self.loop = loop
+        if self.listeners and self.handle is None:
+            self.beat(loop.time())
+
+    def stop(self):
+        """Stop beating."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def beat(self, expected):
+        """Notify the listeners and schedule the next beat."""
+        now = self.loop.time()
+        lag = max(now - expected, 0.0)
+        for listener in self.listeners:
+            listener(lag)
+        self.handle = self.loop.call_later(self.interval, self.beat, now + self.interval)
+
+
+class CaptureBudget:
+
+    """Throttle capturing when the toolbar is too expensive.
+
+    The toolbar's own work is measured (`with budget.measure(): ...`) and summed per window.
+    When the work takes more than `max_overhead` fraction of the window or the event loop's
+    lag is greater than `max_lag` seconds, only every Nth request is captured (N is doubled
+    each window up to `max_skip`). N is halved back while the budget is respected.
+
+    """
+
+    def __init__(self, max_overhead=0.1, max_lag=0.1, window=1.0, max_skip=1024):
+        """Initialize the budget."""
+        self.max_overhead = max_overhead
+        self.max_lag = max_lag
+        self.window = window
+        self.max_skip = max_skip
+
+        self.skip = 1
+        self.counter = 0
+        self.spent = self.lag = 0.0
+        self.overhead = self.last_lag = 0.0
+        self.total_spent = 0.0
+        self.allowed = self.throttled = 0
+        self.started = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return bool(self.max_overhead or self.max_lag)
+
+    def heartbeat(self, lag):
+        """Account the event loop's lag (see `Heartbeat`)."""
+        self.lag = max(self.lag, lag)
+        self.update()
+
+    def measure(self):
+        """Measure the toolbar's work."""
+        return BudgetMeasure(self)
+
+    def measure_await(self, coro):
+        """Measure the coroutine's steps only (the time it's suspended isn't the toolbar's)."""
+        measure = BudgetMeasure(self)
+        return TrackedCoroutine(coro, measure.start, measure.stop)
+
+    def spend(self, seconds):
+        """Account the toolbar's work."""
+        self.spent += seconds
+        self.total_spent += seconds
+
+    def update(self):
+        """Close the window and adjust the capturing frequency."""
+        now = time.perf_counter()
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return
+
+        self.overhead = self.spent / elapsed
+        self.last_lag = self.lag
+        if (self.max_overhead and self.overhead > self.max_overhead) or \
+                (self.max_lag and self.lag > self.max_lag):
+            self.skip = min(self.skip * 2, self.max_skip)
+        elif self.skip > 1:
+            self.skip //= 2
+
+        self.spent = self.lag = 0.0
+        self.started = now
+
+    def allow(self):
+        """Check the request could be captured."""
+        if not self.enabled:
+            return True
+
+        self.update()
+        self.counter += 1
+        if self.counter >= self.skip:
+            self.counter = 0
+            self.allowed += 1
+            return True
+
+        self.throttled += 1
+        return False
+
+
+class BudgetMeasure:
+
+    """Measure a block of the toolbar's work."""
+
+    __slots__ = 'budget', 'started'
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.started = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        if self.started is not None:
+            self.budget.spend(time.perf_counter() - self.started)
+            self.started = None
+
+
+class LoopWatchdog:
+
+    """Detect blocks of the event loop and capture the blocking stacks.
+
+    The heartbeat (see `Heartbeat`) stamps the time in the loop every `interval` seconds. A
+    watchdog thread checks the stamps: when the heartbeat is late for more than `threshold`
+    seconds, the loop thread's stack is captured (once per block). The block is attached to
+    the captured request which is running (`watchdog.running` is switched by the request's
+    context callbacks). The block's duration is measured when the loop gets control back.
+
+    """
+
+    def __init__(self, threshold=0.1, interval=None, size=20):
+        """Initialize the watchdog."""
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.size = size
+        self.worst = []
+        self.total = 0
+        self.running = None
+        self.pending = None
+        self.beat = self.reported = None
+        self.thread_id = None
+        self.stopped = False
+        self._counter = 0
+
+    def start(self, heartbeat):
+        """Listen to the heartbeat and start the watchdog thread (in the loop's thread)."""
+        self.interval = heartbeat.interval
+        self.thread_id = threading.get_ident()
+        self.beat = time.perf_counter()
+        heartbeat.add(self.heartbeat)
+        thread = threading.Thread(target=self.run, name='debugtoolbar-watchdog')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop the watchdog thread."""
+        self.stopped = True
+
+    def heartbeat(self, lag):
+        """Stamp the time (in the loop's thread)."""
+        self.finish()
+        self.beat = time.perf_counter()
+
+    def run(self):
+        """Check the heartbeat (in the watchdog's thread)."""
+        while not self.stopped:
+            time.sleep(self.interval)
+            beat = self.beat
+            if beat == self.reported or self.pending is not None:
+                continue
+
+            expected = beat + self.interval
+            if time.perf_counter() - expected < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            self.reported = beat
+            running = self.running
+            block = {
+                'since': expected,
+                'time': time.time(),
+                'duration': None,
+                'stack': ''.join(traceback.format_stack(frame, limit=30)),
+                'request': running and '%s %s' % (running.request.method, running.request.path),
+            }
+            del frame
+            self.pending = block
+            if running is not None:
+                running.blocks.append(block)
+
+    def finish(self):
+        """Measure the pending block (in the loop's thread)."""
+        block = self.pending
+        if block is None:
+            return
+
+        self.pending = None
+        block['duration'] = time.perf_counter() - block['since']
+        self.total += 1
+        self._counter += 1
+        item = (block['duration'], self._counter, block)
+        if len(self.worst) < self.size:
+            heapq.heappush(self.worst, item)
+        else:
+            heapq.heappushpop(self.worst, item)
+
+    def blocks(self):
+        """Get the worst blocks (from the longest)."""
+        return [block for _, _, block in sorted(self.worst, reverse=True)]
+
+
+class RetentionPolicy:
+
+    """Decide whether a request should be kept in the history by its latency.
+
+    :param threshold: A default latency threshold (in seconds), None to keep all requests
+    :param routes: A mapping of route names to thresholds
+
+    """
+
+    def __init__(self, threshold=None, routes=None):
+        self.threshold = threshold
+        self.routes = dict(routes or {})
+
+    def __call__(self, route, duration):
+        """Check the request should be retained."""
+        threshold = self.routes.get(route, self.threshold)
+        return threshold is None or duration >= threshold
+
+
+class RouteCounters(OrderedDict):
+
+    """ Count requests and their time per route. """
+
+    def add(self, route, duration):
+        """ Count the request. """
+        counter = self.get(route)
+        if counter is None:
+            counter = self[route] = [0, 0.0, 0.0]
+        counter[0] += 1
+        counter[1] += duration
+        if duration > counter[2]:
+            counter[2] = duration
+
+
+class Histogram:
+
+    """ A log-linear histogram of durations (HDR-style).
+
+    Durations are counted in microseconds. Every power of two is split into `SUB_BUCKETS`
+    linear buckets, so the relative error is below 1 / SUB_BUCKETS. The counts are kept in
+    a flat array of a fixed size, so recording doesn't allocate and histograms are merged
+    by adding the arrays.
+
+    """
+
+    __slots__ = 'counts', 'count', 'total', 'max'
+
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+    MAX_VALUE = (1 << 32) - 1
+    SIZE = (MAX_VALUE.bit_length() - SUB_BITS + 1) << SUB_BITS
+    EMPTY = array('I', bytes(4 * SIZE))
+
+    def __init__(self):
+        self.counts = array('I', self.EMPTY)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def index(cls, value):
+        """ Get a bucket's index for the value (in microseconds). """
+        if value < cls.SUB_BUCKETS:
+            return value
+        if value > cls.MAX_VALUE:
+            value = cls.MAX_VALUE
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return ((shift + 1) << cls.SUB_BITS) + (value >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def value(cls, index):
+        """ Get the middle of the bucket's range (in microseconds). """
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        return ((cls.SUB_BUCKETS + (index & (cls.SUB_BUCKETS - 1))) << shift) + \
+            ((1 << shift) - 1) / 2
+
+    def record(self, duration):
+        """ Count the duration (in seconds). """
+        self.counts[self.index(int(duration * 1000000))] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        """ Add the other histogram's counts. """
+        counts = self.counts
+        for idx, count in enumerate(other.counts):
+            if count:
+                counts[idx] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def reset(self):
+        """ Clear the histogram in place. """
+        self.counts[:] = self.EMPTY
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def percentile(self, percent):
+        """ Estimate the percentile (in seconds). """
+        if not self.count:
+            return 0.0
+        rank = max(1, percent * self.count / 100)
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value(idx) / 1000000, self.max)
+        return self.max
+
+
+class RouteStats:
+
+    """ Sliding windows of a route's latencies and errors.
+
+    The time is split into slots of the given width, every slot has its own histogram. The
+    slots are reused in a ring, so a window is a merge of the latest slots.
+
+    """
+
+    __slots__ = 'width', 'histograms', 'epochs', 'errors'
+
+    def __init__(self, size, width):
+        self.width = width
+        self.histograms = [None] * size
+        self.epochs = array('q', [-1]) * size
+        self.errors = array('I', [0]) * size
+
+    def record(self, now, duration, error=False):
+        """ Count the request in the current slot. """
+        epoch = int(now // self.width)
+        pos = epoch % len(self.epochs)
+        histogram = self.histograms[pos]
+        if self.epochs[pos] != epoch:
+            if histogram is None:
+                histogram = self.histograms[pos] = Histogram()
+            else:
+                histogram.reset()
+            self.epochs[pos] = epoch
+            self.errors[pos] = 0
+
+        histogram.record(duration)
+        if error:
+            self.errors[pos] += 1
+
+    def window(self, now, seconds):
+        """ Merge the slots of the latest seconds, return the histogram and errors count. """
+        epoch = int(now // self.width)
+        size = len(self.epochs)
+        histogram, errors = Histogram(), 0
+        for epoch in range(epoch - min(size, math.ceil(seconds / self.width)) + 1, epoch + 1):
+            pos = epoch % size
+            if self.epochs[pos] == epoch:
+                histogram.merge(self.histograms[pos])
+                errors += self.errors[pos]
+        return histogram, errors
+
+
+class RoutePerformance(OrderedDict):
+
+    """ Measure latencies, throughput and error rates of all the requests per route.
+
+    :param windows: Sliding windows to report (in seconds)
+    :param width: A slot's width (in seconds), the windows' precision
+
+    """
+
+    def __init__(self, windows=(60, 300, 900), width=15):
+        super(RoutePerformance, self).__init__()
+        self.windows = sorted(windows)
+        self.width = width
+        self.size = math.ceil(self.windows[-1] / width) + 1
+        self.started = time.monotonic()
+
+    def record(self, route, duration, status):
+        """ Count the request (server errors are counted as errors). """
+        stats = self.get(route)
+        if stats is None:
+            stats = self[route] = RouteStats(self.size, self.width)
+        stats.record(time.monotonic(), duration, status >= 500)
+
+    def summary(self, seconds):
+        """ Summarize the routes' stats for the latest seconds. """
+        now = time.monotonic()
+        elapsed = max(min(seconds, now - self.started), 1)
+        result = []
+        for route, stats in self.items():
+            histogram, errors = stats.window(now, seconds)
+            if not histogram.count:
+                continue
+            result.append({
+                'route': route,
+                'count': histogram.count,
+                'rps': histogram.count / elapsed,
+                'errors': errors * 100 / histogram.count,
+                'avg': histogram.total / histogram.count,
+                'p50': histogram.percentile(50),
+                'p95': histogram.percentile(95),
+                'p99': histogram.percentile(99),
+                'max': histogram.max,
+            })
+        return sorted(result, key=lambda r: r['count'], reverse=True)
+
+
+class Broker:
+
+    """ In-process publish/subscribe.
+
+    Every subscriber has a bounded queue, the oldest messages are dropped when a subscriber
+    doesn't keep up.
+
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.subscriptions = set()
+
+    def subscribe(self):
+        """ Create a subscription (should be called from a coroutine). """
+        subscription = Subscription(self.maxsize)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, message):
+        """ Send the message to all the subscribers. """
+        for subscription in self.subscriptions:
+            subscription.put(message)
+
+
+class Subscription:
+
+    """ A subscriber's queue. """
+
+    __slots__ = 'queue', 'event', 'dropped'
+
+    def __init__(self, maxsize):
+        self.queue = deque(maxlen=maxsize)
+        self.event = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, message):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(message)
+        self.event.set()
+
+    async def get(self, timeout=None):
+        """ Wait for messages and return all of them (an empty list by timeout). """
+        if not self.queue:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        messages = list(self.queue)
+        self.queue.clear()
+        self.event.clear()
+        return messages
+
+
+RE_BODY = re.compile(b'</body>', re.I)
+
+
+def find_body_end(body):
+    """ Find a position of the last closing body tag (-1 when there is no tag). """
+    position = body.rfind(b'</body>')
+    for match in RE_BODY.finditer(body, position + 1):
+        position = match.start()
+    return position
+
+
+class Snippet:
+
+    """ A precompiled Debug Toolbar code with a slot for request id.
+
+    The encoded parts are cached per charset, so rendering is a single bytes join.
+
+    """
+
+    SLOT = '__debugtoolbar_request_id__'
+
+    def __init__(self, text):
+        self.parts = text.split(self.SLOT)
+        self.encoded = {}
+
+    def render(self, request_id, charset='utf-8'):
+        parts = self.encoded.get(charset)
+        if parts is None:
+            parts = self.encoded[charset] = [part.encode(charset) for part in self.parts]
+        return request_id.encode(charset).join(parts)
+
+
+class StreamInjector:
+
+    """ Inject a snippet before the last closing body tag of a streamed body (see
+    `find_body_end`).
+
+    The chunks are scanned incrementally, a tag split across chunks is found too (the last
+    bytes of a chunk are held until the next one). The bytes from the last found tag are held
+    until the body is finished (usually it's only `</body></html>`), but no more than `WINDOW`
+    bytes: a tag followed by more data (e.g. in an inline script) is passed on. When the body
+    has no closing tag it's passed as is.
+
+    """
+
+    __slots__ = 'snippet', 'tail', 'injected'
+
+    HOLD = len(b'</body>') - 1
+    WINDOW = 4 * 1024
+
+    def __init__(self, snippet):
+        self.snippet = snippet
+        self.tail = b''
+        self.injected = False
+
+    def feed(self, chunk):
+        """ Process a chunk and return the bytes to write. """
+        if self.injected:
+            return chunk
+
+        data = self.tail + bytes(chunk)
+        split = find_body_end(data)
+        if split < 0 or len(data) - split > self.WINDOW:
+            split = max(len(data) - self.HOLD, 0)
+        self.tail = data[split:]
+        return data[:split]
+
+    def flush(self):
+        """ Return the rest of the body (with the snippet when the tag has been found). """
+        data, self.tail = self.tail, b''
+        if self.injected or find_body_end(data) != 0:
+            return data
+        self.injected = True
+        return self.snippet + data
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DECOMPRESSION_ERRORS = (zlib.error,) if brotli is None else (zlib.error, brotli.error)
+
+
+def inject_compressed(body, encoding, snippet, chunk_size=64 * 1024):
+    """ Inject a snippet into the compressed body.
+
+    * gzip -- the snippet is appended as a separate gzip member (a multi-member gzip body
+      is a valid one), the body is only decompressed to check it has a closing body tag;
+    * deflate -- the body is decompressed, injected and compressed back chunk by chunk;
+    * br -- the same if the `brotli` package is installed.
+
+    :return: The new body or None when the encoding isn't supported (or the body has no
+        closing body tag, or it couldn't be decompressed).
+
+    """
+    encoding = encoding.strip().lower()
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            if not body.startswith(b'\x1f\x8b'):
+                return None
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if not has_body_end(
+                    decompressor.decompress(body[start:start + chunk_size])
+                    for start in range(0, len(body), chunk_size)) or not decompressor.eof:
+                return None
+            return body + gzip_member(snippet)
+
+        if encoding == 'deflate':
+            # Both zlib-wrapped and raw deflate streams are used in the wild
+            wbits = zlib.MAX_WBITS if body[:1] == b'\x78' else -zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            injector = StreamInjector(snippet)
+            chunks = []
+            for start in range(0, len(body), chunk_size):
+                data = decompressor.decompress(body[start:start + chunk_size])
+                chunks.append(compressor.compress(injector.feed(data)))
+            data = injector.feed(decompressor.flush()) + injector.flush()
+            if not decompressor.eof:
+                return None
+            chunks.append(compressor.compress(data))
+            chunks.append(compressor.flush())
+            return b''.join(chunks)
+
+        if encoding == 'br' and brotli is not None:
+            injector = StreamInjector(snippet)
+            return brotli.compress(injector.feed(brotli.decompress(body)) + injector.flush())
+
+    # A malformed body is left as is
+    except DECOMPRESSION_ERRORS:
+        return None
+
+    return None
+
+
+def has_body_end(chunks):
+    """ Check the body's chunks have a closing body tag. """
+    tail = b''
+    for chunk in chunks:
+        data = tail + chunk
+        if RE_BODY.search(data):
+            return True
+        tail = data[-StreamInjector.HOLD:]
+    return False
+
+
+def gzip_member(data):
+    """ Compress the data into a gzip member. """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class RollingStats:
+
+    """ Keep the latest values and count all of them. """
+
+    __slots__ = 'values', 'count'
+
+    def __init__(self, size=1000):
+        self.values = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.count += 1
+
+    @property
+    def avg(self):
+        return sum(self.values) / len(self.values) if self.values else 0.0
+
+    @property
+    def max(self):
+        return max(self.values) if self.values else 0.0
+
+
+class TimedMiddlewareFactory:
+
+    """ Measure time spent inside a middleware layer excluding its inner handler.
+
+    The timings are recorded only for captured requests (see `MIDDLEWARE_TIMINGS`).
+
+    """
+
+    def __init__(self, factory, stats):
+        self.factory = factory
+        self.name = repr(factory)
+        self.stats = stats
+
+    def __repr__(self):
+        return self.name
+
+    async def __call__(self, app, handler):
+        name = self.name
+
+        async def inner(request):
+            timings = MIDDLEWARE_TIMINGS.get()
+            if timings is None or name not in timings:
+                return await handler(request)
+
+            started = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                timings[name][1] += time.perf_counter() - started
+
+        middleware = await self.factory(app, inner)
+
+        async def timed(request):
+            timings = MIDDLEWARE_TIMINGS.get()
+            if timings is None:
+                return await middleware(request)
+
+            timing = timings[name] = [0.0, 0.0]
+            started = time.perf_counter()
+            try:
+                return await middleware(request)
+            finally:
+                timing[0] = time.perf_counter() - started
+                self.stats.add(timing[0] - timing[1])
+
+        return timed
+
+
+class LogRecordTracker:
+
+    """ Route log records to the active request's buffer (see `LOG_RECORDS`).
+
+    The records are taken from the log record factory, so the logging configuration isn't
+    changed (the root logger's handlers, `logging.basicConfig`, `logging.lastResort`).
+
+    """
+
+    def __init__(self):
+        self._previous = None
+
+    def install(self):
+        """ Wrap the record factory. """
+        if self._previous is None:
+            self._previous = logging.getLogRecordFactory()
+            logging.setLogRecordFactory(self.factory)
+
+    def uninstall(self):
+        """ Restore the record factory (if it hasn't been replaced since). """
+        if self._previous is not None:
+            if logging.getLogRecordFactory() == self.factory:
+                logging.setLogRecordFactory(self._previous)
+            self._previous = None
+
+    def factory(self, *args, **kwargs):
+        """ Create a record and store its snapshot. """
+        record = self._previous(*args, **kwargs)
+        records = LOG_RECORDS.get()
+        if records is None:
+            return record
+
+        try:
+            message = record.getMessage()
+        except Exception:  # noqa, the handlers will report the error
+            message = str(record.msg)
+        records.append(LogEntry(
+            message, record.created, record.levelname, record.pathname, record.lineno))
+        return record
 
 
 class ContextSwitcher:
-    """This object is alternative to *yield from*. It is useful in cases
-    when you need to track context switches inside coroutine.
 
-    see: https://www.python.org/dev/peps/pep-0380/#formal-semantics
+    """Track context switches of a coroutine.
+
+    The callbacks registered with `add_context_in` are called when the coroutine is
+    started/resumed and the ones registered with `add_context_out` when it is
+    suspended/finished. ::
+
+        context_switcher = ContextSwitcher()
+        context_switcher.add_context_in(lambda: print('in'))
+        response = await context_switcher(handler(request))
+
+    When there are no callbacks the coroutine is returned as is.
+
     """
+
     def __init__(self):
         self._on_context_switch_out = []
         self._on_context_switch_in = []
@@ -49,53 +1023,448 @@ class ContextSwitcher:
         assert callable(callback), 'callback should be callable'
         self._on_context_switch_out.append(callback)
 
-    def __call__(self, expr):
-        for callbale in self._on_context_switch_in:
-            callbale()
+    def __call__(self, coro):
+        if not self._on_context_switch_in and not self._on_context_switch_out:
+            return coro
+        return TrackedCoroutine(
+            coro, chain_callbacks(self._on_context_switch_in),
+            chain_callbacks(self._on_context_switch_out))
+
+
+def noop():
+    """Do nothing."""
+
+
+def chain_callbacks(callbacks):
+    """Combine the callbacks into a single callable (it's called on each step)."""
+    if not callbacks:
+        return noop
+    if len(callbacks) == 1:
+        return callbacks[0]
+    callbacks = tuple(callbacks)
+
+    def call():
+        for callback in callbacks:
+            callback()
+
+    return call
+
+
+class TrackedCoroutine:
 
-        _i = iter(expr)
+    """Drive a coroutine (native or generator based) and call the callbacks on each step."""
+
+    __slots__ = '_iterator', '_send', '_context_in', '_context_out'
+
+    def __init__(self, coro, context_in, context_out):
+        self._iterator = coro.__await__() if hasattr(coro, '__await__') else iter(coro)
+        self._send = self._iterator.send
+        self._context_in = context_in
+        self._context_out = context_out
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._context_in()
         try:
-            _y = next(_i)
-        except StopIteration as _e:
-            _r = _e.value
+            return self._send(None)
+        finally:
+            self._context_out()
+
+    def send(self, value):
+        self._context_in()
+        try:
+            return self._send(value)
+        finally:
+            self._context_out()
+
+    def throw(self, *exc_info):
+        self._context_in()
+        try:
+            return self._iterator.throw(*exc_info)
+        finally:
+            self._context_out()
+
+    def close(self):
+        return self._iterator.close()
+
+
+class TaskRecord:
+
+    """ A task created by a captured request. """
+
+    __slots__ = 'name', 'site', 'stack', 'created', 'finished', 'state', 'outlived'
+
+    def __init__(self, name, site, stack):
+        self.name = name
+        self.site = site
+        self.stack = stack
+        self.created = time.perf_counter()
+        self.finished = None
+        self.state = 'pending'
+        self.outlived = False
+
+
+class TaskTracker:
+
+    """ Record the tasks created in the captured requests' context (see `TASKS`).
+
+    The task factory is installed to the loop while any request is captured (the
+    installations are counted) and the loop's previous factory is restored after.
+
+    """
+
+    ASYNCIO_ROOT = op.dirname(asyncio.__file__)
+
+    def __init__(self, stack_limit=10):
+        self.stack_limit = stack_limit
+        self.pending = weakref.WeakKeyDictionary()
+        self.loop = None
+        self._refs = 0
+        self._previous = None
+
+    def install(self, loop):
+        """ Install the task factory. """
+        if not self._refs:
+            self.loop = loop
+            self._previous = loop.get_task_factory()
+            loop.set_task_factory(self.factory)
+        self._refs += 1
+
+    def uninstall(self):
+        """ Restore the loop's task factory when no requests are captured. """
+        self._refs -= 1
+        if not self._refs and self.loop.get_task_factory() == self.factory:
+            self.loop.set_task_factory(self._previous)
+
+    def factory(self, loop, coro, **kwargs):
+        """ Create a task and record it in the request's context. """
+        if self._previous is None:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
         else:
-            while 1:
-                try:
-                    for callbale in self._on_context_switch_out:
-                        callbale()
-                    _s = yield _y
-                    for callbale in self._on_context_switch_in:
-                        callbale()
-                except GeneratorExit as _e:
-                    try:
-                        _m = _i.close
-                    except AttributeError:
-                        pass
-                    else:
-                        _m()
-                    raise _e
-                except BaseException as _e:
-                    _x = sys.exc_info()
-                    try:
-                        _m = _i.throw
-                    except AttributeError:
-                        raise _e
-                    else:
-                        try:
-                            _y = _m(*_x)
-                        except StopIteration as _e:
-                            _r = _e.value
-                            break
-                else:
-                    try:
-                        if _s is None:
-                            _y = next(_i)
-                        else:
-                            _y = _i.send(_s)
-                    except StopIteration as _e:
-                        _r = _e.value
-                        break
-        result = _r
-        for callbale in self._on_context_switch_out:
-            callbale()
-        return result
+            task = self._previous(loop, coro, **kwargs)
+
+        records = TASKS.get()
+        if records is not None:
+            frame = sys._getframe(1)
+            while frame is not None and frame.f_code.co_filename.startswith(
+                    self.ASYNCIO_ROOT):
+                frame = frame.f_back
+            code = frame.f_code if frame is not None else None
+            record = TaskRecord(
+                getattr(coro, '__qualname__', None) or repr(coro),
+                code and '%s (%s:%d)' % (
+                    code.co_name, op.basename(code.co_filename), frame.f_lineno),
+                frame and ''.join(traceback.format_stack(frame, limit=self.stack_limit)))
+            del frame
+            records.append(record)
+            self.pending[task] = record
+            task.add_done_callback(self.done)
+
+        return task
+
+    def done(self, task):
+        """ Record the task's result. """
+        record = self.pending.pop(task, None)
+        if record is None:
+            return
+
+        record.finished = time.perf_counter()
+        if task.cancelled():
+            record.state = 'cancelled'
+        else:
+            # Don't retrieve the exception, asyncio should still report the unretrieved ones
+            exc = getattr(task, '_exception', None)
+            record.state = exc is None and 'done' or 'error: %r' % exc
+
+
+class MemoryTracer:
+
+    """ Start tracing memory allocations while any request is captured.
+
+    The tracing is counted by the captured requests and stopped after the last one (only when
+    it has been started here). When `frames` is 0 the tracing isn't started, but it's used if
+    it has been started elsewhere (`PYTHONTRACEMALLOC`).
+
+    """
+
+    FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        tracemalloc.Filter(False, op.join(op.dirname(op.abspath(__file__)), '*')),
+    )
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self._refs = 0
+        self._started = False
+
+    def start(self):
+        """ Start tracing if needed, return True when the allocations are traced. """
+        if not self._refs and self.frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started = True
+        self._refs += 1
+        return tracemalloc.is_tracing()
+
+    def stop(self):
+        """ Stop tracing after the last request. """
+        self._refs -= 1
+        if not self._refs and self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def snapshot(self):
+        """ Take a snapshot of the allocations without the toolbar's own ones. """
+        return tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+
+
+class GCTracker:
+
+    """ Record garbage collections in the captured requests' context (see `GC_COLLECTIONS`).
+
+    The `gc.callbacks` hook is registered while any request is captured. A collection is
+    attributed to the request in which context it has been triggered. The pauses are summed per
+    route (`pauses` is {route: [collections, total, max]}).
+
+    """
+
+    def __init__(self):
+        self.pauses = OrderedDict()
+        self._refs = 0
+        self._started = None
+
+    def install(self):
+        """ Register the hook. """
+        if not self._refs:
+            gc.callbacks.append(self.callback)
+        self._refs += 1
+
+    def uninstall(self):
+        """ Unregister the hook when no requests are captured. """
+        self._refs -= 1
+        if not self._refs and self.callback in gc.callbacks:
+            gc.callbacks.remove(self.callback)
+
+    def callback(self, phase, info):
+        """ Measure a collection. """
+        if phase == 'start':
+            self._started = time.perf_counter()
+            return
+
+        started, self._started = self._started, None
+        collections = GC_COLLECTIONS.get()
+        if collections is None or started is None:
+            return
+
+        collections.append((
+            info['generation'], info['collected'], info['uncollectable'],
+            time.perf_counter() - started))
+
+    def add(self, route, collections):
+        """ Sum the request's pauses by the route. """
+        if not collections:
+            return
+        pauses = self.pauses.get(route)
+        if pauses is None:
+            pauses = self.pauses[route] = [0, 0.0, 0.0]
+        for _, _, _, duration in collections:
+            pauses[0] += 1
+            pauses[1] += duration
+            if duration > pauses[2]:
+                pauses[2] = duration
+
+
+class TemplateRecord:
+
+    """ A template rendered by a captured request and the templates loaded to render it. """
+
+    __slots__ = 'name', 'keys', 'size', 'duration', 'templates'
+
+    def __init__(self, name, keys=None, size=None):
+        self.name = name
+        self.keys = keys
+        self.size = size
+        self.duration = None
+        self.templates = []
+
+
+class TemplateTracker:
+
+    """ Time the templates rendered in the captured requests' context (see `TEMPLATES`).
+
+    `render` of the Muffin-Jinja2 plugin is timed. The templates loaded by `get_template`
+    (the rendered one, its parents and includes) are attributed to the render and marked as
+    compiled or loaded from the cache. The toolbar's own templates are excluded.
+
+    """
+
+    EXCLUDE = 'debugtoolbar/'
+
+    def __init__(self):
+        self.rendering = ContextVar('debugtoolbar_rendering', default=None)
+        self.loading = ContextVar('debugtoolbar_loading', default=None)
+        self._patched = []
+
+    def install(self, plugin):
+        """ Patch the plugin's render and its environment. """
+        env = plugin.env
+        render, get_template, compile_ = plugin.render, env.get_template, env.compile
+        exclude = self.EXCLUDE
+
+        async def tracked_render(path, **context):
+            records = TEMPLATES.get()
+            if records is None or not isinstance(path, str) or path.startswith(exclude):
+                return await render(path, **context)
+
+            record = TemplateRecord(path, len(context), sizeof(context))
+            records.append(record)
+            token = self.rendering.set(record)
+            started = time.perf_counter()
+            try:
+                return await render(path, **context)
+            finally:
+                record.duration = time.perf_counter() - started
+                self.rendering.reset(token)
+
+        def tracked_get_template(name, *args, **kwargs):
+            records = TEMPLATES.get()
+            if records is None or not isinstance(name, str) or name.startswith(exclude):
+                return get_template(name, *args, **kwargs)
+
+            load = [name, False, None]
+            token = self.loading.set(load)
+            started = time.perf_counter()
+            try:
+                return get_template(name, *args, **kwargs)
+            finally:
+                load[2] = time.perf_counter() - started
+                self.loading.reset(token)
+                record = self.rendering.get()
+                if record is None:
+                    record = TemplateRecord(name)
+                    records.append(record)
+                record.templates.append(tuple(load))
+
+        def tracked_compile(*args, **kwargs):
+            load = self.loading.get()
+            if load is not None:
+                load[1] = True
+            return compile_(*args, **kwargs)
+
+        self._patched = [
+            (owner, name, vars(owner).get(name)) for owner, name in (
+                (plugin, 'render'), (env, 'get_template'), (env, 'compile'))]
+        plugin.render = tracked_render
+        env.get_template = tracked_get_template
+        env.compile = tracked_compile
+
+    def uninstall(self):
+        """ Restore the patched methods. """
+        while self._patched:
+            owner, name, method = self._patched.pop()
+            if method is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, method)
+
+
+class LRUCache(History):
+
+    """ History which moves the accessed items to the end. """
+
+    def get(self, key, default=None):
+        """ Get the item and mark it as recently used. """
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+
+class StackSampler:
+
+    """Sample stacks of the given threads from a background thread.
+
+    A collector is activated for a thread (usually the event loop's one) and receives
+    the thread's collapsed stack every `interval` seconds until it is deactivated.
+
+    """
+
+    def __init__(self, interval=0.005):
+        """Initialize the sampler. The thread is started with a first activation."""
+        self.interval = interval
+        self.active = {}
+        self._labels = {}
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def activate(self, collector, thread_id=None):
+        """Start collecting samples for the given thread."""
+        self.active[thread_id or threading.get_ident()] = collector
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='debugtoolbar-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+        self._wakeup.set()
+
+    def deactivate(self, collector, thread_id=None):
+        """Stop collecting samples for the given thread."""
+        thread_id = thread_id or threading.get_ident()
+        if self.active.get(thread_id) is collector:
+            del self.active[thread_id]
+
+    def run(self):
+        """Sample the active threads."""
+        while True:
+            if not self.active:
+                self._wakeup.clear()
+                self._wakeup.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for thread_id, collector in list(self.active.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    collector(self.collapse(frame))
+
+    def collapse(self, frame):
+        """Convert the frame to a collapsed stack (root first)."""
+        stack = []
+        labels = self._labels
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = '%s (%s:%d)' % (
+                    code.co_name, op.basename(code.co_filename), code.co_firstlineno)
+            stack.append(label)
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+
+def flamegraph(samples):
+    """Build a flamegraph's tree from collapsed stacks.
+
+    :param samples: A mapping of collapsed stacks to counts of samples.
+    :return: A list of nodes: dict(name, value, percent, children)
+
+    """
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for stack, count in samples.items():
+        root['value'] += count
+        node = root
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'name': name, 'value': 0, 'children': {}})
+            node['value'] += count
+
+    def prepare(node, total):
+        children = sorted(node['children'].values(), key=lambda n: n['value'], reverse=True)
+        for child in children:
+            child['percent'] = 100.0 * child['value'] / (total or 1)
+            child['children'] = prepare(child, child['value'])
+        return children
+
+    return prepare(root, root['value'])
@@ -40,8 +40,8 @@ setup(
         'Natural Language :: English',
         'Natural Language :: Russian',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: Software Development :: Testing',
@@ -51,4 +51,5 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=install_requires,
+    python_requires='>=3.7',
 )
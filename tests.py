@@ -1,6 +1,11 @@
+import asyncio
+import logging
+
 import muffin
 import pytest
 
+from muffin_debugtoolbar import panels
+
 
 @pytest.fixture(scope='session')
 def app(loop):
@@ -14,6 +19,64 @@ def app(loop):
     def index(request):
         return '<body>Hello, World!</body>'
 
+    @app.register('/log')
+    def log(request):
+        logging.warning('Log %s', 'message')
+        return '<body>Logged</body>'
+
+    @app.register('/stream')
+    async def stream(request):
+        response = muffin.StreamResponse()
+        response.content_type = 'text/html'
+        response.content_length = len(b'<body>Streamed</body>')
+        await response.prepare(request)
+        response.write(b'<body>Stre')
+        response.write(b'amed</bo')
+        response.write(b'dy>')
+        return response
+
+    @app.register('/identity')
+    def identity(request):
+        return muffin.Response(
+            text='<body>Identity</body>', content_type='text/html',
+            headers={'Content-Encoding': 'identity'})
+
+    @app.register('/task')
+    async def task(request):
+        await asyncio.ensure_future(asyncio.sleep(0))
+        asyncio.ensure_future(asyncio.sleep(0.1))
+        return '<body>Spawned</body>'
+
+    @app.register('/gc')
+    def collect(request):
+        import gc
+        gc.collect()
+        return '<body>Collected</body>'
+
+    @app.register('/sql')
+    def sql(request):
+        import sqlite3
+        import tempfile
+        conn = sqlite3.connect(tempfile.gettempdir() + '/debugtoolbar-tests.db')
+        conn.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT)')
+        for pk in (1, 2, 3):
+            conn.execute('SELECT * FROM users WHERE id = ?', (pk,)).fetchall()
+        conn.close()
+        return '<body>Queried</body>'
+
+    @app.register('/cpu')
+    def cpu(request):
+        import time
+        started = time.process_time()
+        while time.process_time() - started < 0.05:
+            pass
+        return '<body>Computed</body>'
+
+    @app.register('/slow')
+    async def slow(request):
+        await asyncio.sleep(10)
+        return '<body>Slept</body>'
+
     @app.register('/raise')
     def exc(request):
         return 1 / 0
@@ -21,6 +84,13 @@ def app(loop):
     return app
 
 
+def test_shutdown_without_start(loop):
+    app = muffin.Application(
+        'debug-shutdown', loop=loop, PLUGINS=['muffin_jinja2', 'muffin_debugtoolbar'])
+    loop.run_until_complete(app.ps.debugtoolbar.on_shutdown(app))
+    assert app.ps.debugtoolbar.middleware_stats == {}
+
+
 def test_debugtoolbar(client):
     response = client.get('/')
     assert "DebugToolbar" in response.text
@@ -31,3 +101,817 @@ def test_debugtoolbar(client):
     response = client.get('/_debug')
     assert 'History' in response.text
     assert 'Global' in response.text
+
+
+def test_has_panel(app):
+
+    class CustomLoggingDebugPanel(panels.LoggingDebugPanel):
+        pass
+
+    dbtb = app.ps.debugtoolbar
+    assert dbtb.has_panel(panels.LoggingDebugPanel)
+    assert not dbtb.has_panel(panels.ResourcesDebugPanel)
+
+    # The hooks are installed for the panels' subclasses too
+    panels_, dbtb.cfg.panels = dbtb.cfg.panels, [CustomLoggingDebugPanel]
+    try:
+        assert dbtb.has_panel(panels.LoggingDebugPanel)
+    finally:
+        dbtb.cfg.panels = panels_
+
+
+def get_panel(app, panel_cls):
+    history = app.ps.debugtoolbar.history
+    state = history[next(reversed(history))]
+    return next(panel for panel in state.panels if panel.name == panel_cls.name)
+
+
+def test_timing_panel(app, client):
+    client.get('/')
+    panel = get_panel(app, panels.TimingDebugPanel)
+    assert panel.context['wall_time'] >= panel.context['cpu_time'] > 0
+    assert panel.context['switches'] >= 0
+    assert 'Timing' in panel.nav_title
+
+
+def test_tasks_panel(app, client):
+    client.get('/task')
+    panel = get_panel(app, panels.TasksDebugPanel)
+    awaited, spawned = panel.context['tasks']
+    assert awaited['state'] == 'done' and not awaited['outlived']
+    assert spawned['state'] == 'pending' and spawned['outlived']
+    assert 'task' in spawned['site']
+    assert '1 outlived' in panel.nav_title
+    assert app.loop.get_task_factory() is None
+
+
+def test_panels_cleanup(app, client):
+    import gc
+
+    dbtb = app.ps.debugtoolbar
+    dbtb.cfg.intercept_exc = False
+    try:
+        client.get('/raise', status=500)
+    finally:
+        dbtb.cfg.intercept_exc = 'debug'
+
+    assert app.loop.get_task_factory() is None
+    assert dbtb.tasks._refs == 0
+    assert dbtb.gc._refs == 0 and dbtb.gc.callback not in gc.callbacks
+
+
+def test_memory_panel(app, loop):
+    import tracemalloc
+
+    panel = panels.MemoryDebugPanel(app)
+    panel.wrap_handler(None, None)
+    data = [bytes(1024) for _ in range(1024)]
+    loop.run_until_complete(panel.process_response(None))
+
+    assert panel.tracing
+    assert panel.size >= 1024 * 1024 and panel.peak >= panel.size
+    assert panel.blocks >= 1024
+    filename, lineno, size, count = panel.sites[0]
+    assert filename == __file__ and size >= 1024 * 1024
+    assert 'KB' in panel.nav_title
+    assert data
+
+    # The tracing is stopped even when the response isn't processed
+    panel = panels.MemoryDebugPanel(app)
+    panel.wrap_handler(None, None)
+    panel.cleanup()
+    panel.cleanup()
+    assert not tracemalloc.is_tracing()
+    assert app.ps.debugtoolbar.memory._refs == 0
+
+
+def test_gc_panel(app, client):
+    import gc
+
+    client.get('/gc')
+    panel = get_panel(app, panels.GCDebugPanel)
+    collection = panel.context['collections'][-1]
+    assert collection['generation'] == 2
+    assert collection['duration'] > 0
+    assert 'ms' in panel.nav_title
+
+    tracker = app.ps.debugtoolbar.gc
+    assert tracker.callback not in gc.callbacks
+    assert sum(count for count, _, _ in tracker.pauses.values()) >= 1
+
+
+def test_resources_panel(app, client):
+    # The panel is opt-in
+    dbtb = app.ps.debugtoolbar
+    assert panels.ResourcesDebugPanel not in dbtb.cfg.panels
+
+    dbtb.cfg.panels.append(panels.ResourcesDebugPanel)
+    try:
+        client.get('/cpu')
+    finally:
+        dbtb.cfg.panels.remove(panels.ResourcesDebugPanel)
+
+    panel = get_panel(app, panels.ResourcesDebugPanel)
+    usage = {title: value for title, value, _ in panel.context['usage']}
+    assert usage['User CPU time'] + usage['System CPU time'] >= 40  # ms
+    assert usage['Minor page faults'] >= 0
+    assert 'CPU' in panel.nav_title
+
+
+def test_sql_panel(app, client):
+    client.get('/sql')
+    panel = get_panel(app, panels.SQLDebugPanel)
+    queries = panel.context['queries']
+    assert len(queries) == 4
+    assert queries[1]['params'] == [1]
+    assert 'sql' in queries[1]['site']
+    assert 'SQL (4,' in panel.nav_title
+
+    group, = panel.context['repeated']
+    assert group['kind'] == 'N+1' and group['count'] == 3
+
+    response = client.get(panel.context['explain_url'] + '1')
+    assert 'SEARCH' in response.text
+
+
+def test_sqlite_adapter():
+    import sqlite3
+    from muffin_debugtoolbar.sql import SQLiteAdapter
+
+    connect = sqlite3.connect
+    adapter = SQLiteAdapter()
+    adapter.install()
+    assert sqlite3.connect is not connect
+    adapter.uninstall()
+    assert sqlite3.connect is connect
+
+
+def test_sql_normalize():
+    from muffin_debugtoolbar.sql import normalize
+
+    assert normalize("SELECT * FROM t WHERE id IN (1, 2,3) AND name = 'it''s'") == \
+        'SELECT * FROM t WHERE id IN (?) AND name = ?'
+    assert normalize('SELECT *\n FROM t WHERE a = %(a)s AND b = $1 AND c = :c') == \
+        'SELECT * FROM t WHERE a = ? AND b = ? AND c = ?'
+
+
+def test_sequential_calls():
+    from muffin_debugtoolbar.client import HTTPCall, sequential
+
+    def call(task, started, finished):
+        call = HTTPCall('GET', '/', task)
+        call.started, call.finished = started, finished
+        return call
+
+    first, second, concurrent = call(1, 0, 1), call(1, 1, 3), call(2, 0.5, 2)
+    (chain, duration, longest), = sequential([concurrent, second, first])
+    assert chain == [first, second]
+    assert duration == 3 and longest == 2
+
+
+def test_http_client_panel(app, client, loop):
+    import aiohttp
+    if not hasattr(aiohttp, 'TraceConfig'):
+        pytest.skip('aiohttp>=3.0 is required')
+
+    from muffin_debugtoolbar.utils import HTTP_CALLS
+
+    # The panel is opt-in
+    assert panels.HTTPClientDebugPanel not in app.ps.debugtoolbar.cfg.panels
+
+    async def hello(request):
+        return aiohttp.web.Response(text='Hello')
+
+    async def run():
+        server = aiohttp.web.Application()
+        server.router.add_get('/', hello)
+        runner = aiohttp.web.AppRunner(server)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, 'localhost', 0)
+        await site.start()
+        url = 'http://localhost:%d/' % site._server.sockets[0].getsockname()[1]
+
+        panel = panels.HTTPClientDebugPanel(app)
+        panel.wrap_handler(None, None)
+        async with aiohttp.ClientSession() as session:
+            for _ in range(2):
+                async with session.get(url) as response:
+                    await response.read()
+        await panel.process_response(None)
+        await runner.cleanup()
+        assert HTTP_CALLS.get() is None
+        return panel.render_vars()
+
+    context = loop.run_until_complete(run())
+    first, second = context['calls']
+    assert first['status'] == second['status'] == 200
+    assert first['reused'] is False and second['reused'] is True
+    assert first['received'] == 5
+    assert len(context['sequential']) == 1
+
+    # The sessions' initialization is restored
+    from muffin_debugtoolbar.client import ClientTracer
+
+    init = aiohttp.ClientSession.__init__
+    tracer = ClientTracer()
+    tracer.install()
+    assert aiohttp.ClientSession.__init__ is not init
+    tracer.uninstall()
+    assert aiohttp.ClientSession.__init__ is init
+
+
+def test_template_tracker(loop):
+    import jinja2
+    from types import SimpleNamespace
+    from muffin_debugtoolbar.utils import TEMPLATES, TemplateTracker
+
+    env = jinja2.Environment(loader=jinja2.DictLoader({
+        'base.html': '<body>{% block body %}{% endblock %}</body>',
+        'index.html': '{% extends "base.html" %}{% block body %}{{ name }}{% endblock %}',
+        'debugtoolbar/panel.html': '',
+    }))
+
+    async def render(path, **context):
+        return env.get_template(path).render(**context)
+
+    plugin = SimpleNamespace(env=env, render=render)
+    tracker = TemplateTracker()
+    tracker.install(plugin)
+
+    async def run():
+        records = []
+        token = TEMPLATES.set(records)
+        assert await plugin.render('index.html', name='World') == '<body>World</body>'
+        await plugin.render('debugtoolbar/panel.html')
+        TEMPLATES.reset(token)
+        return records
+
+    record, = loop.run_until_complete(run())
+    assert record.name == 'index.html' and record.keys == 1 and record.duration > 0
+    assert [(name, compiled) for name, compiled, _ in record.templates] == [
+        ('index.html', True), ('base.html', True)]
+
+    record, = loop.run_until_complete(run())
+    assert not any(compiled for _, compiled, _ in record.templates)
+
+    tracker.uninstall()
+    assert plugin.render is render
+
+
+def test_sizeof():
+    import sys
+    from muffin_debugtoolbar.utils import sizeof
+
+    items = ['item']
+    assert sizeof(items) == sys.getsizeof(items) + sys.getsizeof('item')
+
+    # The shared and the self-referencing containers are counted once
+    context = {'items': items, 'same': items}
+    context['context'] = context
+    assert sizeof(context) == sizeof(items) + sys.getsizeof(context) + sum(
+        sys.getsizeof(key) for key in context)
+
+
+def test_stack_sampler():
+    import time
+    from muffin_debugtoolbar.utils import StackSampler
+
+    def busy():
+        started = time.perf_counter()
+        while time.perf_counter() - started < 0.1:
+            pass
+
+    samples = []
+    sampler = StackSampler(0.001)
+    sampler.activate(samples.append)
+    busy()
+    sampler.deactivate(samples.append)
+
+    assert samples
+    assert all('test_stack_sampler' in stack for stack in samples)
+    assert any(stack.endswith('busy (tests.py:%d)' % busy.__code__.co_firstlineno)
+               for stack in samples)
+
+
+def test_profiler_panel(app, client):
+    panel = panels.ProfilerDebugPanel(app)
+    panel.add_sample('<module> (app.py:1);<lambda> (app.py:2)')
+    panel.add_sample('<module> (app.py:1);<lambda> (app.py:2)')
+    assert panel.nav_title == 'Profiler (2)'
+
+    content = panel.render_content()
+    assert '&lt;lambda&gt; (app.py:2)' in content
+    assert '<lambda>' not in content and '<module>' not in content
+
+
+def test_flamegraph():
+    from muffin_debugtoolbar.utils import flamegraph
+
+    tree = flamegraph({'main;handler;query': 3, 'main;handler': 1})
+    assert len(tree) == 1
+    assert tree[0]['value'] == 4
+    handler = tree[0]['children'][0]
+    assert handler['children'][0]['name'] == 'query'
+    assert handler['children'][0]['percent'] == 75.0
+
+
+def test_logging_panel(app, client):
+    client.get('/log')
+    panel = get_panel(app, panels.LoggingDebugPanel)
+    assert [record['message'] for record in panel.context['records']] == ['Log message']
+
+    client.get('/')
+    panel = get_panel(app, panels.LoggingDebugPanel)
+    assert not panel.has_content
+
+
+def test_logging_config(app):
+    import io
+
+    # The toolbar doesn't add handlers, so the application could configure logging later
+    handlers, logging.root.handlers[:] = logging.root.handlers[:], []
+    stream = io.StringIO()
+    try:
+        logging.basicConfig(stream=stream, format='%(message)s')
+        logging.warning('Configured')
+    finally:
+        logging.root.handlers[:] = handlers
+
+    assert stream.getvalue() == 'Configured\n'
+
+
+def test_context_switcher(loop):
+    from muffin_debugtoolbar.utils import ContextSwitcher
+
+    async def handler():
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return 42
+
+    switcher = ContextSwitcher()
+    coro = handler()
+    assert switcher(coro) is coro
+    assert loop.run_until_complete(coro) == 42
+
+    switches = []
+    switcher.add_context_in(lambda: switches.append('in'))
+    switcher.add_context_out(lambda: switches.append('out'))
+    assert loop.run_until_complete(switcher(handler())) == 42
+    assert switches == ['in', 'out'] * 3
+
+    switches = []
+    switcher = ContextSwitcher()
+    switcher.add_context_in(lambda: switches.append('in'))
+    switcher.add_context_in(lambda: switches.append('in2'))
+    assert loop.run_until_complete(switcher(handler())) == 42
+    assert switches == ['in', 'in2'] * 3
+
+
+def test_timed_middleware(loop):
+    from muffin_debugtoolbar.utils import MIDDLEWARE_TIMINGS, RollingStats, TimedMiddlewareFactory
+
+    async def factory(app, handler):
+        async def middleware(request):
+            await asyncio.sleep(0.01)
+            return await handler(request)
+        return middleware
+
+    async def handler(request):
+        await asyncio.sleep(0.02)
+        return 42
+
+    stats = RollingStats()
+    timed = TimedMiddlewareFactory(factory, stats)
+    assert repr(timed) == repr(factory)
+
+    middleware = loop.run_until_complete(timed(None, handler))
+    assert loop.run_until_complete(middleware(None)) == 42
+    assert stats.count == 0
+
+    timings = {}
+    token = MIDDLEWARE_TIMINGS.set(timings)
+    assert loop.run_until_complete(middleware(None)) == 42
+    MIDDLEWARE_TIMINGS.reset(token)
+
+    total, inner = timings[repr(factory)]
+    assert total > inner >= 0.02
+    assert stats.count == 1
+    assert 0.01 <= stats.avg == stats.max < 0.02
+
+
+def test_loop_watchdog(loop):
+    import time
+    from types import SimpleNamespace
+    from muffin_debugtoolbar.utils import Heartbeat, LoopWatchdog
+
+    watchdog = LoopWatchdog(0.05)
+    heartbeat = Heartbeat(watchdog.interval)
+    running = SimpleNamespace(blocks=[], request=SimpleNamespace(method='GET', path='/'))
+
+    async def handler():
+        await asyncio.sleep(0.1)
+        watchdog.running = running
+        time.sleep(0.2)
+        watchdog.running = None
+        watchdog.finish()
+        await asyncio.sleep(0.1)
+
+    lags = []
+    heartbeat.add(lags.append)
+    watchdog.start(heartbeat)
+    heartbeat.start(loop)
+    try:
+        loop.run_until_complete(handler())
+    finally:
+        heartbeat.stop()
+        watchdog.stop()
+
+    block, = running.blocks
+    assert block['request'] == 'GET /'
+    assert 'handler' in block['stack']
+    assert block['duration'] > 0.1
+    assert watchdog.blocks()[0] is block
+
+    # The listeners share the beats
+    assert max(lags) > 0.1
+
+
+def test_request_filter():
+    from types import SimpleNamespace
+    from muffin_debugtoolbar.utils import RequestFilter
+
+    def request(path='/', method='GET', host='127.0.0.1', headers=None, cookies=None):
+        return SimpleNamespace(
+            path=path, method=method, headers=headers or {}, cookies=cookies or {}, GET={},
+            transport=SimpleNamespace(get_extra_info=lambda name: (host, 54321)))
+
+    check = RequestFilter(hosts=['127.0.0.1', '10.0.0.0/8'], exclude=['/static/'])
+    assert check(request())
+    assert check(request(host='10.1.2.3'))
+    assert not check(request(host='8.8.8.8'))
+    assert not check(request(path='/static/app.js'))
+
+    check = RequestFilter(
+        path='/api/', methods=['post'], headers={'Accept': 'text/html'}, flag='debug')
+    assert check(request(
+        '/api/users', 'POST', headers={'Accept': 'text/html'}, cookies={'debug': '1'}))
+    assert not check(request('/api/users', 'POST', headers={'Accept': 'text/html'}))
+    assert not check(request('/users', 'POST', cookies={'debug': '1'}))
+    assert not check(request('/api/users', cookies={'debug': '1'}))
+
+
+def test_capture_sampler():
+    from muffin_debugtoolbar.utils import CaptureSampler
+
+    sample = CaptureSampler(rate=3)
+    assert [sample() for _ in range(6)] == [False, False, True] * 2
+
+    sample = CaptureSampler(max_per_second=2)
+    assert [sample() for _ in range(3)] == [True, True, False]
+
+    sample = CaptureSampler(max_per_second=1)
+    assert sample()
+    sample.refund()
+    assert [sample(), sample()] == [True, False]
+
+    sample = CaptureSampler(rate=3)
+    assert [sample() for _ in range(3)] == [False, False, True]
+    sample.refund()
+    assert sample()
+
+
+def test_capture_budget():
+    from muffin_debugtoolbar.utils import CaptureBudget
+
+    budget = CaptureBudget(max_overhead=0.1, max_lag=0, window=0)
+    assert budget.allow()
+
+    budget.spend(1)
+    assert not budget.allow()
+    assert budget.skip == 2
+    assert budget.throttled == 1
+
+    assert budget.allow()
+    assert budget.skip == 1
+
+
+def test_capture_budget_measure(loop):
+    import time
+    from muffin_debugtoolbar.utils import CaptureBudget
+
+    async def process():
+        time.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+    budget = CaptureBudget(window=0)
+    loop.run_until_complete(budget.measure_await(process()))
+    assert 0.01 <= budget.spent < 0.05
+
+
+def test_retention_policy():
+    from muffin_debugtoolbar.utils import RetentionPolicy, RouteCounters
+
+    retain = RetentionPolicy()
+    assert retain('index', 0)
+
+    retain = RetentionPolicy(0.5, {'report': 2})
+    assert retain('index', 0.6)
+    assert not retain('index', 0.1)
+    assert not retain('report', 1)
+    assert retain('report', 3)
+
+    counters = RouteCounters()
+    counters.add('index', 0.1)
+    counters.add('index', 0.3)
+    assert counters['index'] == [2, 0.4, 0.3]
+
+
+def test_retention_injection(app, client):
+    from muffin_debugtoolbar.utils import RetentionPolicy
+
+    dbtb = app.ps.debugtoolbar
+    retention, dbtb.retention = dbtb.retention, RetentionPolicy(60)
+    try:
+        count = sum(count for count, _, _ in dbtb.counters.values())
+        response = client.get('/')
+    finally:
+        dbtb.retention = retention
+
+    # The request isn't kept, so the toolbar isn't injected (it would link to nothing)
+    assert 'DebugToolbar' not in response.text
+    assert sum(count for count, _, _ in dbtb.counters.values()) == count + 1
+
+
+def test_identity_injection(client):
+    # The identity encoding is the uncompressed body
+    response = client.get('/identity')
+    assert 'DebugToolbar' in response.text
+
+
+def test_broken_panel(app, client):
+
+    class BrokenDebugPanel(panels.DebugPanel):
+        name = 'Broken'
+
+        def render_vars(self):
+            raise ValueError('Broken')
+
+    dbtb = app.ps.debugtoolbar
+    dbtb.cfg.panels.append(BrokenDebugPanel)
+    try:
+        count = sum(count for count, _, _ in dbtb.counters.values())
+        response = client.get('/')
+    finally:
+        dbtb.cfg.panels.remove(BrokenDebugPanel)
+
+    # The application's response isn't broken, the request is only counted
+    assert response.status_code == 200
+    assert 'Hello, World!' in response.text
+    assert sum(count for count, _, _ in dbtb.counters.values()) == count + 1
+
+
+def test_histogram():
+    from muffin_debugtoolbar.utils import Histogram
+
+    histogram = Histogram()
+    for ms in range(1, 101):
+        histogram.record(ms / 1000)
+
+    assert histogram.count == 100
+    assert histogram.max == 0.1
+    assert abs(histogram.percentile(50) - 0.05) < 0.05 / Histogram.SUB_BUCKETS
+    assert abs(histogram.percentile(99) - 0.099) < 0.099 / Histogram.SUB_BUCKETS
+
+    merged = Histogram()
+    merged.merge(histogram)
+    merged.merge(histogram)
+    assert merged.count == 200
+    assert merged.percentile(50) == histogram.percentile(50)
+
+    merged.reset()
+    assert merged.count == 0 and not any(merged.counts)
+
+
+def test_route_performance(app, client):
+    performance = app.ps.debugtoolbar.performance
+
+    def count():
+        return sum(r['count'] for r in performance.summary(60))
+
+    before = count()
+    client.get('/')
+    client.get('/raise')
+    assert count() == before + 2
+    assert not any(route.startswith('debugtoolbar.') for route in performance)
+
+    route = performance.summary(60)[0]
+    assert route['p50'] <= route['p99'] <= route['max']
+    assert any(r['errors'] > 0 for r in performance.summary(60))
+
+
+def test_history_snapshots(app, client):
+    from muffin_debugtoolbar.history import MemoryHistory
+
+    client.get('/')
+    history = app.ps.debugtoolbar.history
+    snapshot = history[next(reversed(history))]
+    assert snapshot.path == '/'
+    assert snapshot.size > 0
+    assert not hasattr(snapshot, 'request')
+
+    response = client.get('/_debug/' + snapshot.id)
+    assert 'HTTP Headers' in response.text
+
+    budget = MemoryHistory(snapshot.size * 2)
+    for key in 'abc':
+        budget[key] = snapshot
+    assert list(budget) == ['b', 'c']
+    assert budget.bytes == snapshot.size * 2
+
+
+def test_sqlite_history(app, client, tmpdir):
+    from muffin_debugtoolbar.history import create_history
+
+    client.get('/')
+    history = app.ps.debugtoolbar.history
+    snapshot = history[next(reversed(history))]
+
+    path = 'sqlite://' + str(tmpdir.join('history.db'))
+    shared = create_history(path, app=app)
+    shared[snapshot.id] = snapshot
+    assert snapshot.id in shared
+    assert shared[snapshot.id] is snapshot
+
+    shared.flush()
+    assert not shared.pending
+    loaded = create_history(path, app=app)[snapshot.id]
+    assert loaded.json == snapshot.json
+    assert loaded.panels[0].render_content() == snapshot.panels[0].render_content()
+
+    # The oldest snapshots are evicted by the total size
+    size = len(snapshot.dumps())
+    shared.max_bytes = size * 2
+    for key in 'abc':
+        shared[key] = snapshot
+    shared.close()
+    assert list(shared) == ['b', 'c']
+    assert shared.conn.execute('SELECT bytes FROM history_size').fetchone()[0] == size * 2
+
+
+def test_broker(loop):
+    from muffin_debugtoolbar.utils import Broker
+
+    async def run():
+        broker = Broker(maxsize=2)
+        subscription = broker.subscribe()
+        for message in range(3):
+            broker.publish(message)
+        assert await subscription.get() == [1, 2]
+        assert subscription.dropped == 1
+        assert await subscription.get(timeout=0.01) == []
+
+        broker.unsubscribe(subscription)
+        broker.publish(4)
+        assert await subscription.get(timeout=0.01) == []
+
+    loop.run_until_complete(run())
+
+
+def test_sse(app, client, loop):
+    import json
+
+    client.get('/')
+    history = app.ps.debugtoolbar.history
+
+    async def read_event():
+        server = await loop.create_server(app.make_handler(), '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        try:
+            writer.write(b'GET /_debug/sse HTTP/1.0\r\nHost: localhost\r\n\r\n')
+            headers = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            event = await asyncio.wait_for(reader.readuntil(b'\n\n'), 5)
+        finally:
+            writer.close()
+            server.close()
+        return headers, event
+
+    headers, event = loop.run_until_complete(read_event())
+    assert b'text/event-stream' in headers
+
+    # The toolbar reads the request's id from the event's id and the details from the data
+    fields = dict(line.split(': ', 1) for line in event.decode('utf-8').strip().split('\n'))
+    assert fields['event'] == 'new_request'
+    assert fields['id'] in history
+    details = json.loads(fields['data'])
+    assert details == history[fields['id']].json
+
+
+def test_cancelled_request(app, client, loop):
+    history = app.ps.debugtoolbar.history
+
+    async def cancel():
+        server = await loop.create_server(app.make_handler(), '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        try:
+            writer.write(b'GET /slow HTTP/1.0\r\nHost: localhost\r\n\r\n')
+            await asyncio.sleep(0.1)
+        finally:
+            writer.close()
+
+        # The client has gone away, the handler is cancelled
+        try:
+            for _ in range(50):
+                await asyncio.sleep(0.02)
+                states = [history[key] for key in history if history[key].path == '/slow']
+                if states:
+                    return states
+        finally:
+            server.close()
+
+    state, = loop.run_until_complete(cancel())
+    assert state.status == 499
+
+
+def test_panel_view(app, client):
+    client.get('/')
+    history = app.ps.debugtoolbar.history
+    request_id = next(reversed(history))
+
+    url = '/_debug/%s/panel/pDebugHTTPHeadersPanel' % request_id
+    response = client.get(url)
+    assert 'Request Headers' in response.text
+    assert (request_id, 'pDebugHTTPHeadersPanel') in app.ps.debugtoolbar.rendered_panels
+    assert client.get(url).text == response.text
+
+    client.get('/_debug/%s/panel/unknown' % request_id, status=404)
+
+
+def test_stream_injection(client):
+    response = client.get('/stream')
+    assert "DebugToolbar" in response.text
+    assert response.text.startswith('<body>Streamed')
+    assert response.text.endswith('</body>')
+
+
+def test_stream_injector():
+    from muffin_debugtoolbar.utils import StreamInjector
+
+    def inject(*chunks):
+        injector = StreamInjector(b'[TB]')
+        return b''.join(injector.feed(chunk) for chunk in chunks) + injector.flush()
+
+    assert inject(b'<body>Stre', b'amed</bo', b'dy>') == b'<body>Streamed[TB]</body>'
+    assert inject(b'<body>"</body>"', b'</BO', b'DY></html>') == \
+        b'<body>"</body>"[TB]</BODY></html>'
+    assert inject(b'{"json": 1}') == b'{"json": 1}'
+
+    # An early tag doesn't hold the rest of the stream
+    script = b'<script>"</body>"</script>'
+    injector = StreamInjector(b'[TB]')
+    written = len(injector.feed(script))
+    for _ in range(1000):
+        written += len(injector.feed(b'.' * 1024))
+        assert len(injector.tail) <= StreamInjector.WINDOW
+    assert written + len(injector.flush()) == len(script) + 1000 * 1024
+    assert inject(b'<body>"</body>"', b'.' * 8192, b'</body>') == \
+        b'<body>"</body>"' + b'.' * 8192 + b'[TB]</body>'
+
+
+def test_inject_compressed():
+    import gzip
+    import zlib
+    from muffin_debugtoolbar.utils import inject_compressed
+
+    body = b'<html><body>Hello</body></html>'
+    assert gzip.decompress(inject_compressed(gzip.compress(body), 'gzip', b'<p>Toolbar</p>')) \
+        == body + b'<p>Toolbar</p>'
+    assert zlib.decompress(inject_compressed(zlib.compress(body), 'deflate', b'<p>Toolbar</p>')) \
+        == b'<html><body>Hello<p>Toolbar</p></body></html>'
+    assert inject_compressed(body, 'unknown', b'') is None
+
+    # A fragment without the closing tag isn't touched
+    fragment = b'<p>Fragment</p>'
+    assert inject_compressed(gzip.compress(fragment), 'gzip', b'<p>Toolbar</p>') is None
+    assert zlib.decompress(
+        inject_compressed(zlib.compress(fragment), 'deflate', b'<p>Toolbar</p>')) == fragment
+
+    # Neither a malformed body
+    assert inject_compressed(gzip.compress(body)[:-10], 'gzip', b'') is None
+    assert inject_compressed(b'\x1f\x8b' + body, 'gzip', b'') is None
+    assert inject_compressed(zlib.compress(body)[:-10], 'deflate', b'') is None
+    assert inject_compressed(b'\x78' + body, 'deflate', b'') is None
+
+
+def test_snippet():
+    from muffin_debugtoolbar.utils import Snippet, find_body_end
+
+    snippet = Snippet('<a href="/_debug/%s">Панель</a>' % Snippet.SLOT)
+    assert snippet.render('42') == '<a href="/_debug/42">Панель</a>'.encode('utf-8')
+    assert snippet.render('42', 'cp1251') == '<a href="/_debug/42">Панель</a>'.encode('cp1251')
+
+    assert find_body_end(b'<body></body>') == 6
+    assert find_body_end(b'<BODY></BODY>') == 6
+    assert find_body_end(b'<p></p>') == -1
+    assert find_body_end(b'<body>"</body>"</BODY>') == 15